@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks for fileProcessor.
+
+Examples:
+
+    benchmarkFileProcessor.py names -n 1000000
+    benchmarkFileProcessor.py discovery -n 1000000 --treeFolder /tmp/tree1M
+    benchmarkFileProcessor.py sort -n 1000000
+    benchmarkFileProcessor.py stages -n 100000 --layout flat
+    benchmarkFileProcessor.py --json run.json run -n 10000
+    benchmarkFileProcessor.py coordinator -n 1000 --workers 2
+
+    The --json option writes the results in a file, so that runs can be
+    compared.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fileProcessor
+
+# defaults
+DEFAULT_numberOfNames = 1000000
+DEFAULT_nameFormat = '${FP_BASENAME}_${FP_COUNTER6}_${FP_ORIGCOUNTER4}${FP_EXTENSION}'
+DEFAULT_command = 'convert ${FP_IN} -thumbnail 250x90 ${FP_OUT}'
+DEFAULT_numberOfFiles = 1000000
+DEFAULT_filesPerFolder = 1000
+DEFAULT_walkThreads = 8
+DEFAULT_sortMemory = 100000
+DEFAULT_numberOfRunFiles = 10000
+DEFAULT_jobs = multiprocessing.cpu_count()
+DEFAULT_runCommands = ['true', 'cat ${FP_IN}']
+DEFAULT_stagesNameFormat = '${FP_BASENAME}_${FP_COUNTER6}_${FP_ORIGCOUNTER7}${FP_EXTENSION}'
+DEFAULT_numberOfCoordinatorFiles = 1000
+DEFAULT_workers = 2
+DEFAULT_coordinatorTimeout = 120.0
+DEFAULT_pollInterval = 0.1
+# the modes of the workers of the coordinator runs: name, options, command
+# and whether a worker is lost while holding a lease
+WORKER_MODES = [('thread', ['-p', '-j', '4'], 'true ${FP_IN}', False),
+                ('batch', ['-p', '-j', '4', '-b', '5'], 'true ${FP_IN_LIST}', False),
+                ('event', ['-e', 'event', '-j', '8'], 'true ${FP_IN}', False),
+                ('batch (one lost)', ['-p', '-j', '4', '-b', '5'],
+                 'true ${FP_IN_LIST}', True)]
+# seconds the lost worker holds its lease
+DEFAULT_lostWorkerDelay = 1.0
+LAYOUT_FLAT = 'flat'
+LAYOUT_DEEP = 'deep'
+DEFAULT_layout = LAYOUT_DEEP
+
+# the results of the benchmarks, written by the --json option
+records = []
+
+
+def report(label, count, elapsed, **measures):
+    print '%-30s %10d items %8.3f s %12.0f items/s' % (label, count, elapsed,
+                                                      count / max(elapsed, 1e-9))
+    record = {'label': label, 'items': count, 'seconds': elapsed,
+              'itemsPerSecond': count / max(elapsed, 1e-9)}
+    record.update(measures)
+    records.append(record)
+
+
+def generateTree(root, numberOfFiles, filesPerFolder, layout=LAYOUT_DEEP):
+
+    # a synthetic tree of empty files with numbered names: the folders hold
+    # filesPerFolder files each and are nested ten per level, or all the
+    # files are in the root with the flat layout
+    if layout == LAYOUT_FLAT:
+        filesPerFolder = numberOfFiles
+
+    count = 0
+    folderIndex = 0
+    while count < numberOfFiles:
+        path = [root]
+        index = folderIndex
+        while layout == LAYOUT_DEEP:
+            path.append('dir%03d' % (index % 10))
+            index //= 10
+            if index == 0:
+                break
+        folder = os.path.join(*path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        for i in xrange(min(filesPerFolder, numberOfFiles - count)):
+            fd = os.open(os.path.join(folder, 'IMG_%07d.jpg' % count),
+                         os.O_CREAT | os.O_WRONLY, 0644)
+            os.close(fd)
+            count += 1
+        folderIndex += 1
+
+
+def legacyListInputFilenames(inputPath, pattern):
+
+    # the walker used by fileProcessor before the DirectoryWalker
+    inputFilenames = []
+    for dirname, dirnames, filenames in os.walk(inputPath):
+        for filename in filenames:
+            if not pattern or pattern.search(filename):
+                inputFilenames.append(os.path.join(dirname, filename))
+
+    return inputFilenames
+
+
+def legacySplitInputFilenames(s):
+
+    # the human sorting key used by fileProcessor before the sorting subsystem
+    dir_name, name = os.path.split(s)
+    base, ext = os.path.splitext(name)
+
+    components = [int(c) if c.isdigit() else c for c in re.split(
+        '([0-9]+)', base)]
+
+    strComponents = []
+    numComponents = []
+    for c in components:
+        try:
+            cStripped = c.strip()
+
+            if len(cStripped):
+                strComponents.append(cStripped.lower())
+        except AttributeError:
+            numComponents.append(c)
+
+    return tuple(numComponents + strComponents)
+
+
+def makeWalkerConfig(inputPath, walkThreads):
+
+    return argparse.Namespace(inputPath=inputPath, recursive=True,
+                              maxDepth=None, walkThreads=walkThreads,
+                              glob=None, dirInclude=None, dirExclude=None)
+
+
+def openTree(args):
+
+    # the folder of the synthetic tree, generated if empty or missing, and
+    # whether it is temporary
+    root = args.treeFolder
+    temporary = root is None
+    if temporary:
+        root = tempfile.mkdtemp(prefix='fileProcessorBenchmark')
+
+    if not os.path.isdir(root) or not os.listdir(root):
+        start = time.time()
+        generateTree(root, args.numberOfFiles, args.filesPerFolder,
+                     args.layout)
+        report('tree generation', args.numberOfFiles, time.time() - start)
+
+    return root, temporary
+
+
+def benchmarkDiscovery(args):
+
+    root, temporary = openTree(args)
+    try:
+        pattern = re.compile(args.fileFilter) if args.fileFilter else None
+
+        start = time.time()
+        count = len(legacyListInputFilenames(root, pattern))
+        report('os.walk (legacy)', count, time.time() - start)
+
+        for walkThreads in sorted(set([1, args.walkThreads])):
+            config = makeWalkerConfig(root, walkThreads)
+            start = time.time()
+            count = len(list(fileProcessor.DirectoryWalker(config, pattern)))
+            report('DirectoryWalker (%d threads)' % walkThreads, count,
+                   time.time() - start)
+    finally:
+        if temporary:
+            shutil.rmtree(root)
+
+
+def benchmarkSort(args):
+
+    # numbered names spread over folders, in a scrambled order
+    inputFilenames = ['/data/input/dir%03d/IMG_%07d copy %d.jpg' %
+                      (i % 100, (i * 7919) % args.numberOfFiles, i % 3)
+                      for i in xrange(args.numberOfFiles)]
+
+    start = time.time()
+    for f in inputFilenames:
+        legacySplitInputFilenames(f)
+    report('legacy key', args.numberOfFiles, time.time() - start)
+
+    start = time.time()
+    for f in inputFilenames:
+        fileProcessor.humanSortKey(f)
+    report('humanSortKey', args.numberOfFiles, time.time() - start)
+
+    start = time.time()
+    sorted(inputFilenames, key=legacySplitInputFilenames)
+    report('sort with legacy key', args.numberOfFiles, time.time() - start)
+
+    config = argparse.Namespace(sortMode=fileProcessor.SORT_HUMAN,
+                                sortMemory=None)
+    start = time.time()
+    fileProcessor.sortInputFilenames(inputFilenames, config)
+    report('sortInputFilenames', args.numberOfFiles, time.time() - start)
+
+    config.sortMemory = args.sortMemory
+    start = time.time()
+    for f in fileProcessor.sortInputFilenames(inputFilenames, config):
+        pass
+    report('external sort (%d in memory)' % args.sortMemory,
+           args.numberOfFiles, time.time() - start)
+
+
+def benchmarkStages(args):
+
+    # the stages of fileProcessor.run() one at a time, with the options of
+    # the command line
+    root, temporary = openTree(args)
+    outputPath = tempfile.mkdtemp(prefix='fileProcessorBenchmarkOutput')
+    try:
+        config = fileProcessor.getParser().parse_args(
+            ['-r', '-s', str(fileProcessor.SORT_HUMAN), '-o', outputPath,
+             '-n', args.nameFormat, '-c', args.command, root])
+        fileProcessor.completeOptions(config)
+        pattern = fileProcessor.compileFileFilter(config)
+
+        start = time.time()
+        entries = list(fileProcessor.listInputFilenames(config, pattern))
+        report('discovery', len(entries), time.time() - start)
+
+        start = time.time()
+        inputFilenames = fileProcessor.sortInputFilenames(entries, config)
+        report('sort', len(inputFilenames), time.time() - start)
+
+        start = time.time()
+        inOutPairs = list(fileProcessor.generateInOutPairs(inputFilenames,
+                                                           config))
+        report('pairs', len(inOutPairs), time.time() - start)
+
+        start = time.time()
+        for inOutPair in inOutPairs:
+            fileProcessor.generateCommand(inOutPair, config)
+        report('commands', len(inOutPairs), time.time() - start)
+
+        start = time.time()
+        for inOutPair in inOutPairs:
+            fileProcessor.generateEnvironment(inOutPair, config)
+        report('environments', len(inOutPairs), time.time() - start)
+    finally:
+        shutil.rmtree(outputPath)
+        if temporary:
+            shutil.rmtree(root)
+
+
+def startFileProcessor(arguments):
+
+    # the command line in a process of its own, its output discarded
+    devNull = open(os.devnull, 'wb')
+    try:
+        script = os.path.splitext(os.path.abspath(fileProcessor.__file__))[0] + '.py'
+        return subprocess.Popen([sys.executable, script] + arguments,
+                                stdout=devNull)
+    finally:
+        devNull.close()
+
+
+def runFileProcessor(arguments):
+
+    # run the command line in a process of its own, returning its exit
+    # status and its peak resident memory in KB (including the commands it
+    # ran, which are tiny next to the interpreter)
+    proc = startFileProcessor(arguments)
+    pid, status, resourceUsage = os.wait4(proc.pid, 0)
+
+    return status, resourceUsage.ru_maxrss
+
+
+def benchmarkRun(args):
+
+    # end to end runs with trivial commands, sequential and in parallel
+    root, temporary = openTree(args)
+    fd, statsFilename = tempfile.mkstemp(prefix='fileProcessorBenchmark',
+                                         suffix='.json')
+    os.close(fd)
+    try:
+        for command in args.runCommand:
+            for label, options in (('sequential', []),
+                                   ('parallel', ['-p', '-j', str(args.jobs)])):
+                start = time.time()
+                status, peakRss = runFileProcessor(
+                    [root, '-r', '-v', '0', '-c', command,
+                     '--statsFile', statsFilename] + options)
+                elapsed = time.time() - start
+                if status != 0:
+                    print 'fileProcessor failed with status', status
+                    continue
+
+                with open(statsFilename) as f:
+                    stats = json.load(f)
+                report('%s: %s' % (label, command), stats['files'], elapsed,
+                       command=command, mode=label, peakRssKB=peakRss,
+                       runFilesPerSecond=stats['filesPerSecond'],
+                       spawnLatency=stats['spawnLatency'],
+                       latency=stats['latency'], phases=stats['phases'])
+                print '%30s peak RSS %d KB, spawn latency p50 %.4f s p95 %.4f s' % (
+                    '', peakRss, stats['spawnLatency']['p50'],
+                    stats['spawnLatency']['p95'])
+    finally:
+        if os.path.exists(statsFilename):
+            os.unlink(statsFilename)
+        if temporary:
+            shutil.rmtree(root)
+
+
+def waitForProcesses(procs, deadline):
+
+    # whether all the processes exited before the deadline. The processes
+    # still running at the deadline are killed
+    while time.time() < deadline and \
+            any(proc.poll() is None for proc in procs):
+        time.sleep(DEFAULT_pollInterval)
+
+    done = True
+    for proc in procs:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+            done = False
+
+    return done
+
+
+def benchmarkCoordinator(args):
+
+    # a coordinator and its workers on this host, talking over a Unix
+    # socket, for each mode of the workers. This is also a regression check:
+    # every file must be reported to the coordinator before the timeout,
+    # which catches the workers that never stop pulling, and the pairs of a
+    # worker killed while holding a lease must be processed by the others.
+    # Returns 1 if a run failed
+    root, temporary = openTree(args)
+    folder = tempfile.mkdtemp(prefix='fileProcessorBenchmark')
+    address = os.path.join(folder, 'coordinator.socket')
+    logFilename = os.path.join(folder, 'coordinator.csv')
+    failed = False
+    try:
+        for label, options, command, loseWorker in WORKER_MODES:
+            start = time.time()
+            deadline = start + args.timeout
+            coordinator = startFileProcessor(
+                [root, '-r', '-v', '0', '-c', 'true',
+                 '--coordinator', address, '-l', logFilename])
+            while not os.path.exists(address) and time.time() < deadline \
+                    and coordinator.poll() is None:
+                time.sleep(DEFAULT_pollInterval)
+
+            # the lost worker leases pairs it never completes
+            lostWorker = None
+            if loseWorker:
+                lostWorker = startFileProcessor([root, '-v', '0', '-c',
+                                                 'exec sleep 3600',
+                                                 '--connect', address])
+                time.sleep(DEFAULT_lostWorkerDelay)
+
+            workers = [startFileProcessor([root, '-v', '0', '-c', command,
+                                           '--connect', address] + options)
+                       for i in xrange(args.workers)]
+            if lostWorker:
+                time.sleep(DEFAULT_lostWorkerDelay)
+                lostWorker.kill()
+                lostWorker.wait()
+            done = waitForProcesses(workers + [coordinator], deadline)
+            elapsed = time.time() - start
+
+            count = 0
+            if os.path.exists(logFilename):
+                with open(logFilename) as f:
+                    count = sum(1 for line in f) - 1
+            if not done or count != args.numberOfFiles:
+                print 'coordinator with %s workers failed: %d of %d files%s' % (
+                    label, count, args.numberOfFiles,
+                    '' if done else ', timed out')
+                failed = True
+                continue
+
+            report('coordinator: %d %s workers' % (args.workers, label),
+                   count, elapsed, mode=label, workers=args.workers)
+    finally:
+        shutil.rmtree(folder)
+        if temporary:
+            shutil.rmtree(root)
+
+    return 1 if failed else 0
+
+
+def addTreeArguments(subparser, numberOfFiles):
+
+    subparser.add_argument('-n', '--numberOfFiles',
+                           type=int,
+                           action='store',
+                           help='number of files of the synthetic tree. Default: %(default)s',
+                           default=numberOfFiles)
+    subparser.add_argument('--filesPerFolder',
+                           type=int,
+                           action='store',
+                           help='number of files in each folder of the synthetic tree. Default: %(default)s',
+                           default=DEFAULT_filesPerFolder)
+    subparser.add_argument('--layout',
+                           type=str,
+                           action='store',
+                           choices=(LAYOUT_FLAT, LAYOUT_DEEP),
+                           help='layout of the synthetic tree: all the files in one folder, or nested folders. Default: %(default)s',
+                           default=DEFAULT_layout)
+    subparser.add_argument('--treeFolder',
+                           type=str,
+                           action='store',
+                           help='folder of the synthetic tree. It is generated if empty or missing, and kept afterwards. If not set, a temporary tree is generated and removed. Default: %(default)s',
+                           default=None)
+
+
+def benchmarkNames(args):
+
+    config = argparse.Namespace(nameFormat=args.nameFormat,
+                                command=args.command,
+                                outputPath='/tmp/fileProcessorBenchmark')
+    inputFilenames = ['/data/input/IMG_%07d.jpg' % i
+                      for i in xrange(args.numberOfNames)]
+
+    # compile once, outside of the timed loops
+    template = fileProcessor.getTemplate(args.nameFormat,
+                                         fileProcessor.getNameRenderer)
+
+    start = time.time()
+    for counter in xrange(args.numberOfNames):
+        template.render('IMG_0001234', '.jpg', counter)
+    report('name template rendering', args.numberOfNames, time.time() - start)
+
+    start = time.time()
+    outputFilenames = [fileProcessor.generateOutputFilename(f, config, counter)
+                       for counter, f in enumerate(inputFilenames)]
+    report('generateOutputFilename', args.numberOfNames, time.time() - start)
+
+    start = time.time()
+    for inOutPair in zip(inputFilenames, outputFilenames):
+        fileProcessor.generateCommand(inOutPair, config)
+    report('generateCommand', args.numberOfNames, time.time() - start)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks for fileProcessor.')
+    parser.add_argument('--json',
+                        type=str,
+                        action='store',
+                        help='write the results in this JSON file. Default: %(default)s',
+                        default=None)
+    subparsers = parser.add_subparsers()
+
+    namesParser = subparsers.add_parser('names',
+                                        help='time the generation of the output names and of the commands')
+    namesParser.add_argument('-n', '--numberOfNames',
+                             type=int,
+                             action='store',
+                             help='number of names to generate. Default: %(default)s',
+                             default=DEFAULT_numberOfNames)
+    namesParser.add_argument('--nameFormat',
+                             type=str,
+                             action='store',
+                             help='the output name format. Default: %(default)s',
+                             default=DEFAULT_nameFormat)
+    namesParser.add_argument('--command',
+                             type=str,
+                             action='store',
+                             help='the command format. Default: %(default)s',
+                             default=DEFAULT_command)
+    namesParser.set_defaults(func=benchmarkNames)
+
+    discoveryParser = subparsers.add_parser('discovery',
+                                            help='time the discovery of the input files against the legacy os.walk based walker')
+    addTreeArguments(discoveryParser, DEFAULT_numberOfFiles)
+    discoveryParser.add_argument('-f', '--fileFilter',
+                                 type=str,
+                                 action='store',
+                                 help='regular expression used to filter the files. Default: %(default)s',
+                                 default=None)
+    discoveryParser.add_argument('--walkThreads',
+                                 type=int,
+                                 action='store',
+                                 help='number of threads of the parallel walk. Default: %(default)s',
+                                 default=DEFAULT_walkThreads)
+    discoveryParser.set_defaults(func=benchmarkDiscovery)
+
+    sortParser = subparsers.add_parser('sort',
+                                       help='time the human sorting keys and the in memory and external sorts')
+    sortParser.add_argument('-n', '--numberOfFiles',
+                            type=int,
+                            action='store',
+                            help='number of file names to sort. Default: %(default)s',
+                            default=DEFAULT_numberOfFiles)
+    sortParser.add_argument('--sortMemory',
+                            type=int,
+                            action='store',
+                            help='number of names sorted in memory by the external sort. Default: %(default)s',
+                            default=DEFAULT_sortMemory)
+    sortParser.set_defaults(func=benchmarkSort)
+
+    stagesParser = subparsers.add_parser('stages',
+                                         help='time the stages of a run (discovery, sort, pairs, commands) on a synthetic tree')
+    addTreeArguments(stagesParser, DEFAULT_numberOfFiles)
+    stagesParser.add_argument('--nameFormat',
+                              type=str,
+                              action='store',
+                              help='the output name format. Default: %(default)s',
+                              default=DEFAULT_stagesNameFormat)
+    stagesParser.add_argument('--command',
+                              type=str,
+                              action='store',
+                              help='the command format. Default: %(default)s',
+                              default=DEFAULT_command)
+    stagesParser.set_defaults(func=benchmarkStages)
+
+    runParser = subparsers.add_parser('run',
+                                      help='time end to end runs with trivial commands, sequential and in parallel: files/s, peak RSS and spawn latency')
+    addTreeArguments(runParser, DEFAULT_numberOfRunFiles)
+    runParser.add_argument('-c', '--runCommand',
+                           type=str,
+                           action='append',
+                           help='command to run, it can be given several times. Default: %s' % ', '.join(DEFAULT_runCommands),
+                           default=None)
+    runParser.add_argument('-j', '--jobs',
+                           type=int,
+                           action='store',
+                           help='number of jobs of the parallel runs. Default: %(default)s',
+                           default=DEFAULT_jobs)
+    runParser.set_defaults(func=benchmarkRun)
+
+    coordinatorParser = subparsers.add_parser('coordinator',
+                                              help='time a coordinator and its workers on this host, for each mode of the workers (threads, batches, event engine), and check that every file is processed')
+    addTreeArguments(coordinatorParser, DEFAULT_numberOfCoordinatorFiles)
+    coordinatorParser.add_argument('-w', '--workers',
+                                   type=int,
+                                   action='store',
+                                   help='number of workers. Default: %(default)s',
+                                   default=DEFAULT_workers)
+    coordinatorParser.add_argument('--timeout',
+                                   type=float,
+                                   action='store',
+                                   help='seconds after which a run is failed and its processes killed. Default: %(default)s',
+                                   default=DEFAULT_coordinatorTimeout)
+    coordinatorParser.set_defaults(func=benchmarkCoordinator)
+
+    args = parser.parse_args()
+    if getattr(args, 'runCommand', False) is None:
+        args.runCommand = DEFAULT_runCommands
+    status = args.func(args)
+
+    if args.json:
+        arguments = dict((k, v) for k, v in vars(args).items() if k != 'func')
+        with open(args.json, 'w') as f:
+            json.dump({'benchmark': args.func.__name__,
+                       'arguments': arguments,
+                       'python': sys.version,
+                       'platform': platform.platform(),
+                       'cpus': multiprocessing.cpu_count(),
+                       'time': time.time(),
+                       'results': records}, f, indent=2)
+
+    sys.exit(status)
@@ -30,6 +30,50 @@ import multiprocessing
 import subprocess
 import csv
 import Queue
+import threading
+import hashlib
+import sqlite3
+import select
+import tempfile
+import time
+import errno
+import collections
+import shlex
+import pipes
+import struct
+import array
+import heapq
+import json
+import fnmatch
+import stat
+import marshal
+import operator
+import mmap
+import shutil
+import itertools
+import socket
+import SocketServer
+import signal
+import traceback
+import cStringIO
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # versions list
 VERSION = '0.1 - alpha'
@@ -42,6 +86,8 @@ VERBOSE_FILE_PROCESSOR_DEBUG = 0x01 << 2
 SORT_NONE = 0
 SORT_LEXICOGRAPHICAL = 1
 SORT_HUMAN = 2
+SORT_MTIME = 3
+SORT_SIZE = 4
 
 # defaults
 DEFAULT_varMarker = '$'             # do not change this!
@@ -56,6 +102,8 @@ DEFAULT_varInFileBaseName = 'IN_BASENAME'
 DEFAULT_varInFileExtension = 'IN_EXTENSION'
 DEFAULT_varOutFile = 'OUT'
 DEFAULT_varOutFileFolder = 'OUT_FOLDER'
+DEFAULT_varInFileList = 'IN_LIST'
+DEFAULT_varOutFileList = 'OUT_LIST'
 
 # DEFAULT_nameFormat = DEFAULT_varMarker + '{' + DEFAULT_varPrefix +
 # DEFAULT_varBaseName + '}_new' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix +
@@ -66,14 +114,90 @@ DEFAULT_verbose = VERBOSE_FILE_PROCESSOR
 DEFAULT_sortMode = SORT_HUMAN
 #DEFAULT_logFilename = './fileProcessorLog.csv'
 DEFAULT_logFilename = None
+LOG_CSV = 'csv'
+LOG_JSONL = 'jsonl'
+LOG_SQLITE = 'sqlite'
+DEFAULT_logFormat = LOG_CSV
+# records written to the log at once, or after so many seconds, so that a
+# long running (--watch) process keeps its log up to date
+DEFAULT_logBatchSize = 1000
+DEFAULT_logFlushInterval = 1.0
+DEFAULT_querySlowest = 10
+SQLITE_HEADER = 'SQLite format 3\0'
 DEFAULT_fileFilter = None
 DEFAULT_counterOffset = 0
+DEFAULT_jobs = multiprocessing.cpu_count()
+DEFAULT_manifestFilename = '.fileProcessorManifest.sqlite'
+# records committed to the manifest at once, or after so many seconds
+DEFAULT_manifestBatchSize = 1000
+DEFAULT_manifestFlushInterval = 1.0
+DEFAULT_journalFilename = '.fileProcessorJournal'
+# the journal is synced to disk every so many entries or seconds
+DEFAULT_journalBatchSize = 1000
+DEFAULT_journalSyncInterval = 1.0
+DEFAULT_hashBlockSize = 1 << 20
+# files larger than this are hashed through mmap
+DEFAULT_mmapThreshold = 64 << 20
+DEFAULT_batchSize = 1
+# a command run through the shell is a single argument, and Linux limits the
+# length of each argument to 128KB (MAX_ARG_STRLEN)
+DEFAULT_maxArgumentLength = 128 * 1024
+DEFAULT_argumentLengthMargin = 4096
+DEFAULT_outputLimit = 64 * 1024
+DEFAULT_readSize = 64 * 1024
+DEFAULT_resultQueueSize = 1024
+DEFAULT_openFilesMargin = 64
+# adaptive concurrency: the limits, the seconds between two adjustments,
+# the seconds after a decrease before the next change (the load average
+# lags) and the drop of throughput that undoes an increase
+DEFAULT_maxLoad = float(DEFAULT_jobs)
+DEFAULT_maxMem = 90.0
+DEFAULT_adaptiveInterval = 2.0
+DEFAULT_adaptiveCooldown = 10.0
+DEFAULT_adaptiveTolerance = 0.05
+DEFAULT_meminfoFilename = '/proc/meminfo'
+# the exit status reported when a command cannot be executed (as the shell does)
+DEFAULT_commandNotFoundStatus = 127
+DEFAULT_statsTop = 10
+DEFAULT_walkThreads = 1
+DEFAULT_walkQueueSize = 1024
+DEFAULT_sortMemory = None
+DEFAULT_leaseSize = 16
+# watch mode: seconds a new file must stay unchanged before it is processed,
+# and seconds between two checks of the candidates (and of the folders when
+# polling)
+DEFAULT_watchSettle = 2.0
+DEFAULT_watchInterval = 0.5
+# the files of fileProcessor itself (manifest, journal, ...) are not watched
+DEFAULT_internalPrefix = '.fileProcessor'
+DEFAULT_inotifyReadSize = 64 * 1024
+# seconds a worker waits before asking again for pairs still leased to others
+DEFAULT_coordinatorPollInterval = 0.5
+# the pairs of a source that may block (coordinator, watcher) are fed through
+# a queue: its size, and the seconds without a pair after which the
+# dispatchers get FEED_IDLE
+DEFAULT_feedQueueSize = 1024
+DEFAULT_feedIdleInterval = 0.1
+FEED_IDLE = object()
+DEFAULT_cacheSize = None
+DEFAULT_cacheLockFilename = '.lock'
+# the eviction brings the cache down to this fraction of its maximum size
+DEFAULT_cacheLowWatermark = 0.9
+DEFAULT_profileTop = 20
+FUNC_POOL_PROCESS = 'process'
+FUNC_POOL_THREAD = 'thread'
+DEFAULT_funcPool = FUNC_POOL_PROCESS
+ENGINE_THREAD = 'thread'
+ENGINE_EVENT = 'event'
+DEFAULT_engine = ENGINE_THREAD
 
 # globals
 
 # this must be in accordance with the defaults
 VAR_REG_EX_FOR_NAME_FORMAT = '\$\{FP_[\w\d]*\}'
 VAR_REG_EX_FOR_NAME_FORMAT_COMPILED = re.compile(VAR_REG_EX_FOR_NAME_FORMAT)
+COUNTER_REG_EX_COMPILED = re.compile('\d+')
+NUMBERS_REG_EX_COMPILED = re.compile('([0-9]+)')
 
 # errors
 ERROR_INPUT_PATH_DOES_NOT_EXIST = -1
@@ -82,23 +206,14 @@ ERROR_INVALID_NAME_FORMAT_LABEL = -3
 ERROR_INVALID_COMMAND_FORMAT_LABEL = -4
 ERROR_COMMAND_PARSING = -5
 ERROR_GENERIC_EXCEPTION = -6
-
-# this class essentially implements the behavior of a static variable
-class generateMatchIteratorStatic(object):
-    def __init__(self):
-        self._matchIterator = None
-
-    def __call__(self, regEx, nameFormat):
-        self.compute(regEx, nameFormat)
-        return self._matchIterator
-
-    def __iter(self):
-        return self._matchIterator
-
-    def compute(self, regEx, nameFormat):
-        self._matchIterator = regEx.finditer(nameFormat)
-
-generateMatchIterator = generateMatchIteratorStatic()
+ERROR_MANIFEST = -7
+ERROR_CACHE = -8
+ERROR_JOURNAL = -9
+ERROR_COORDINATOR = -10
+ERROR_INVALID_OPTIONS = -11
+ERROR_FUNCTION = -12
+ERROR_PROGRAM_NOT_FOUND = -13
+ERROR_INTERRUPTED = -14
 
 # see http://stackoverflow.com/questions/287871/print-in-terminal-with-colors-
 # using-python
@@ -119,138 +234,948 @@ class Colors:
         self.ENDC = ''
 
 
+def hashFile(filename):
+
+    # large files are mapped in memory, which saves copying them through
+    # the read buffers
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= DEFAULT_mmapThreshold:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, DEFAULT_hashBlockSize):
+                    hasher.update(buffer(mapped, offset, DEFAULT_hashBlockSize))
+            finally:
+                mapped.close()
+        else:
+            while True:
+                block = f.read(DEFAULT_hashBlockSize)
+                if not block:
+                    break
+                hasher.update(block)
+
+    return hasher.hexdigest()
+
+
+class Manifest(object):
+
+    # persistent record of the processed inputs stored in a SQLite database.
+    # Lookups go through the primary key index, whereas the records are
+    # buffered and committed in batches. A lock serializes the access from the
+    # worker threads, and SQLite takes care of concurrent fileProcessor
+    # instances sharing the same manifest
+    def __init__(self, filename, useHash=False):
+        self.filename = filename
+        self.useHash = useHash
+        self._lock = threading.Lock()
+        self._pending = []
+        self._lastFlush = time.time()
+
+        self._connection = sqlite3.connect(filename, timeout=60,
+                                           check_same_thread=False)
+        self._connection.text_factory = str
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS manifest ('
+                                 'inputPath TEXT PRIMARY KEY, '
+                                 'size INTEGER, '
+                                 'mtime REAL, '
+                                 'hash TEXT, '
+                                 'command TEXT, '
+                                 'status INTEGER)')
+        self._connection.commit()
+
+    def files(self):
+        # the database files, so that they can be excluded from the inputs
+        return set(os.path.abspath(self.filename + suffix)
+                   for suffix in ('', '-wal', '-shm', '-journal'))
+
+    def isUpToDate(self, inputFilename, inputStat, cmd):
+        # the inputs are keyed on their absolute path, hence the same file
+        # is found whatever the form of the input path given to fileProcessor
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT size, mtime, hash, command, status FROM manifest '
+                'WHERE inputPath = ?',
+                (os.path.abspath(inputFilename),)).fetchone()
+
+        if row is None:
+            return False
+
+        size, mtime, digest, command, status = row
+        if status != 0 or command != cmd:
+            return False
+
+        if size == inputStat.st_size and mtime == inputStat.st_mtime:
+            return True
+
+        # the file was touched: check whether its content did change
+        if self.useHash and digest and size == inputStat.st_size and \
+                digest == hashFile(inputFilename):
+            self.record(inputFilename, inputStat, cmd, status, digest)
+            return True
+
+        return False
+
+    def record(self, inputFilename, inputStat, cmd, status, digest=None):
+        if digest is None and self.useHash and status == 0:
+            try:
+                digest = hashFile(inputFilename)
+            except IOError:
+                digest = None
+
+        with self._lock:
+            self._pending.append((os.path.abspath(inputFilename),
+                                  inputStat.st_size, inputStat.st_mtime,
+                                  digest, cmd, status))
+            if len(self._pending) >= DEFAULT_manifestBatchSize or \
+                    time.time() - self._lastFlush >= DEFAULT_manifestFlushInterval:
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?)',
+                self._pending)
+            self._connection.commit()
+            self._pending = []
+        self._lastFlush = time.time()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._connection.close()
+
+
+class FileProcessorError(Exception):
+
+    # an error stopping a run, with the exit status of the command line
+    def __init__(self, message, code):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class TemplateLabelError(Exception):
+
+    def __init__(self, label):
+        Exception.__init__(self, label)
+        self.label = label
+
+
+class ProgramNotFoundError(Exception):
+
+    def __init__(self, program):
+        Exception.__init__(self, program)
+        self.program = program
+
+
+class Template(object):
+
+    # a format string parsed once in a list of literal and variable segments.
+    # Each variable is bound to a renderer, hence rendering amounts to calling
+    # the renderers and joining the segments
+    def __init__(self, formatStr, getRenderer):
+        self.formatStr = formatStr
+        self.labels = []
+        self._segments = []
+        self._variables = []
+
+        begin = 0
+        for m in VAR_REG_EX_FOR_NAME_FORMAT_COMPILED.finditer(formatStr):
+            if m.start() > begin:
+                self._segments.append(formatStr[begin:m.start()])
+            begin = m.end()
+
+            label = m.group(0)[len(DEFAULT_varPrefix) + 2:-1]
+            renderer = getRenderer(label)
+            if renderer is None:
+                raise TemplateLabelError(label)
+
+            self.labels.append(label)
+            self._variables.append((len(self._segments), renderer))
+            self._segments.append(None)
+
+        if begin < len(formatStr):
+            self._segments.append(formatStr[begin:])
+
+    def render(self, *values):
+        segments = self._segments[:]
+        for i, renderer in self._variables:
+            segments[i] = renderer(*values)
+
+        return ''.join(segments)
+
+
+def getCounterFormat(label, variable):
+    try:
+        numberOfDigits = int(label[len(variable):])
+    except ValueError:
+        return None
+
+    if numberOfDigits > 0:
+        return '%0' + str(numberOfDigits) + 'd'
+    else:
+        return '%d'
+
+
+def generateCounterRenderer(label):
+    counterFormat = getCounterFormat(label, DEFAULT_varCounter)
+    if counterFormat is None:
+        return None
+
+    def renderer(baseName, extension, counter):
+        if counter is None:
+            return ''
+        return counterFormat % counter
+
+    return renderer
+
+
+def generateOrigCounterRenderer(label):
+    counterFormat = getCounterFormat(label, DEFAULT_varOrigCounter)
+    if counterFormat is None:
+        return None
+
+    def renderer(baseName, extension, counter):
+        match = COUNTER_REG_EX_COMPILED.search(baseName)
+        if match is None:
+            return ''
+        return counterFormat % int(match.group(0))
+
+    return renderer
+
+
+# the renderers of the name format receive (baseName, extension, counter)
+def getNameRenderer(label):
+    if label == DEFAULT_varBaseName:
+        return lambda baseName, extension, counter: baseName
+    elif label == DEFAULT_varExtension:
+        return lambda baseName, extension, counter: extension
+    elif label.startswith(DEFAULT_varCounter):
+        return generateCounterRenderer(label)
+    elif label.startswith(DEFAULT_varOrigCounter):
+        return generateOrigCounterRenderer(label)
+
+    return None
+
+
+# the renderers of the command receive (inOutPair, outputPath)
+def getCommandRenderer(label):
+    if label == DEFAULT_varInFile:
+        return lambda inOutPair, outputPath: "\"" + inOutPair[0] + "\""
+    elif label == DEFAULT_varOutFile:
+        return lambda inOutPair, outputPath: "\"" + inOutPair[1] + "\""
+    elif label == DEFAULT_varOutFileFolder:
+        return lambda inOutPair, outputPath: "\"" + outputPath + "\""
+
+    return None
+
+
+# the renderers of the batch command receive (inOutPairs, outputPath)
+def getBatchCommandRenderer(label):
+    if label == DEFAULT_varInFileList:
+        return lambda inOutPairs, outputPath: ' '.join(
+            "\"" + p[0] + "\"" for p in inOutPairs)
+    elif label == DEFAULT_varOutFileList:
+        return lambda inOutPairs, outputPath: ' '.join(
+            "\"" + p[1] + "\"" for p in inOutPairs if p[1])
+    elif label == DEFAULT_varOutFileFolder:
+        return lambda inOutPairs, outputPath: "\"" + outputPath + "\""
+
+    return None
+
+
+# the renderers of the arguments of a command run without the shell are the
+# same as the ones of the command, except that the values are not quoted
+def getArgumentRenderer(label):
+    if label == DEFAULT_varInFile:
+        return lambda inOutPair, outputPath: inOutPair[0]
+    elif label == DEFAULT_varOutFile:
+        return lambda inOutPair, outputPath: inOutPair[1]
+    elif label == DEFAULT_varOutFileFolder:
+        return lambda inOutPair, outputPath: outputPath
+
+    return None
+
+
+def getBatchArgumentRenderer(label):
+    if label == DEFAULT_varOutFileFolder:
+        return lambda inOutPairs, outputPath: outputPath
+
+    return None
+
+
+# the list variables expand to one argument per file
+def getBatchArgumentListRenderer(label):
+    if label == DEFAULT_varInFileList:
+        return lambda inOutPairs, outputPath: [p[0] for p in inOutPairs]
+    elif label == DEFAULT_varOutFileList:
+        return lambda inOutPairs, outputPath: [p[1] for p in inOutPairs if p[1]]
+
+    return None
+
+
+class ArgvTemplate(object):
+
+    # a command split once in its arguments (as the shell would do), each of
+    # them compiled in a Template. An argument made only of a list variable
+    # expands to several arguments
+    def __init__(self, command, getRenderer, getListRenderer=None):
+        self.formatStr = command
+        self.labels = []
+        self._arguments = []
+
+        for token in shlex.split(command):
+            m = VAR_REG_EX_FOR_NAME_FORMAT_COMPILED.match(token)
+            if m and m.end() == len(token) and getListRenderer:
+                label = token[len(DEFAULT_varPrefix) + 2:-1]
+                listRenderer = getListRenderer(label)
+                if listRenderer:
+                    self.labels.append(label)
+                    self._arguments.append((None, listRenderer))
+                    continue
+
+            template = Template(token, getRenderer)
+            self.labels.extend(template.labels)
+            self._arguments.append((template, None))
+
+        # the command gets only the fileProcessor variables in its
+        # environment, hence the program is looked for in the PATH of the
+        # caller, once. A program given by a variable is looked for when the
+        # arguments are rendered
+        self._program = None
+        if self._arguments:
+            template, listRenderer = self._arguments[0]
+            if template and not template.labels:
+                self._program = findProgram(template.formatStr)
+                if self._program is None:
+                    raise ProgramNotFoundError(template.formatStr)
+
+    def render(self, *values):
+        argv = []
+        for template, listRenderer in self._arguments:
+            if listRenderer:
+                argv.extend(listRenderer(*values))
+            else:
+                argv.append(template.render(*values))
+
+        if self._program:
+            argv[0] = self._program
+        elif argv:
+            argv[0] = findProgram(argv[0]) or argv[0]
+
+        return argv
+
+
+def findProgram(program):
+
+    # the full name of the program, as the shell would find it. None if it
+    # cannot be found
+    if os.sep in program:
+        return program
+
+    for folder in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        filename = os.path.join(folder or os.curdir, program)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+
+    return None
+
+
+compiledTemplates = {}
+
+
+def getTemplate(formatStr, getRenderer):
+
+    # the templates are compiled once and cached
+    key = (formatStr, getRenderer)
+    template = compiledTemplates.get(key)
+    if template is None:
+        template = Template(formatStr, getRenderer)
+        compiledTemplates[key] = template
+
+    return template
+
+
+class ResultCache(object):
+
+    # the outputs of the command indexed by the content of the input: the key
+    # is the hash of the input combined with the command format and the
+    # extension of the output. The entries are written to a temporary file
+    # and renamed, hence concurrent workers (and fileProcessor instances)
+    # never see partial entries. The modification time of an entry is its
+    # last use, which drives the LRU eviction once the cache exceeds maxSize
+    def __init__(self, folder, maxSize=None):
+        self.folder = folder
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+        self._size = None
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def key(self, inOutPair, args):
+        hasher = hashlib.sha1(hashFile(inOutPair[0]))
+        hasher.update('\0' + (args.func or args.command) + '\0' +
+                      os.path.splitext(inOutPair[1])[1])
+        return hasher.hexdigest()
+
+    def _entryFilename(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def fetch(self, key, outputFilename):
+        # hard link (or copy across file systems) the entry to the output
+        entryFilename = self._entryFilename(key)
+        try:
+            os.utime(entryFilename, None)
+        except OSError:
+            return False
+
+        temporaryFilename = outputFilename + '.fileProcessorCache'
+        try:
+            try:
+                os.link(entryFilename, temporaryFilename)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    return False
+                shutil.copyfile(entryFilename, temporaryFilename)
+            os.rename(temporaryFilename, outputFilename)
+        except (IOError, OSError):
+            if os.path.exists(temporaryFilename):
+                os.unlink(temporaryFilename)
+            return False
+
+        return True
+
+    def unlinkShared(self, outputFilename):
+        # an output served by the cache shares its data with the cache entry:
+        # it is removed before the command overwrites it
+        try:
+            if os.stat(outputFilename).st_nlink > 1:
+                os.unlink(outputFilename)
+        except OSError:
+            pass
+
+    def store(self, key, outputFilename):
+        entryFilename = self._entryFilename(key)
+        entryFolder = os.path.dirname(entryFilename)
+        try:
+            if not os.path.isdir(entryFolder):
+                os.makedirs(entryFolder)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # the entry is a copy, so that overwriting the output later on does
+        # not alter the cache
+        fd, temporaryFilename = tempfile.mkstemp(dir=entryFolder)
+        os.close(fd)
+        try:
+            shutil.copyfile(outputFilename, temporaryFilename)
+            shutil.copymode(outputFilename, temporaryFilename)
+            os.rename(temporaryFilename, entryFilename)
+        except (IOError, OSError):
+            os.unlink(temporaryFilename)
+            raise
+
+        if self.maxSize:
+            with self._lock:
+                if self._size is None:
+                    self._size = self._computeSize()
+                self._size += os.path.getsize(entryFilename)
+                if self._size > self.maxSize:
+                    self._evict()
+
+    def _entries(self):
+        for dirName, dirNames, filenames in os.walk(self.folder):
+            for filename in filenames:
+                if filename == DEFAULT_cacheLockFilename:
+                    continue
+                fullName = os.path.join(dirName, filename)
+                try:
+                    yield fullName, os.stat(fullName)
+                except OSError:
+                    continue
+
+    def _computeSize(self):
+        return sum(s.st_size for f, s in self._entries())
+
+    def _evict(self):
+        # a file lock serializes the evictions of concurrent fileProcessor
+        # instances. The least recently used entries are removed first
+        lockFile = open(os.path.join(self.folder, DEFAULT_cacheLockFilename), 'a')
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+            size = sum(s.st_size for f, s in entries)
+            target = self.maxSize * DEFAULT_cacheLowWatermark
+            for filename, fileStat in entries:
+                if size <= target:
+                    break
+                try:
+                    os.unlink(filename)
+                    size -= fileStat.st_size
+                except OSError:
+                    pass
+            self._size = size
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+            lockFile.close()
+
+
+def openCache(args):
+
+    if not args.cacheDir:
+        return None
+
+    try:
+        return ResultCache(args.cacheDir, args.cacheSize)
+    except OSError, e:
+        raise FileProcessorError('Cannot open the cache ' + args.cacheDir +
+                                 ': ' + str(e), ERROR_CACHE)
+
+
 def generateCommand(inOutPair, args):
 
-    # detect all the matches to the format variables
-    matchIterator = generateMatchIterator(
-        VAR_REG_EX_FOR_NAME_FORMAT_COMPILED, args.command)
+    return getTemplate(args.command, getCommandRenderer).render(
+        inOutPair, args.outputPath)
 
-    # and replace them with the corresponding value
-    cmd = ''
-    begin = 0
-    oneMatchFound = False
-    for m in matchIterator:
 
-        oneMatchFound = True
+def generateBatchCommand(inOutPairs, args):
 
-        cmd += args.command[begin:m.start()]
-        begin = m.end()
+    return getTemplate(args.command, getBatchCommandRenderer).render(
+        inOutPairs, args.outputPath)
 
-        # get the match
-        label = args.command[m.start() + len(DEFAULT_varPrefix) +
-                             2:m.end() - 1]
 
-        if label == DEFAULT_varInFile:
-            cmd += "\"" + inOutPair[0] + "\""
-        elif label == DEFAULT_varOutFile:
-            cmd += "\"" + inOutPair[1] + "\""
-        elif label == DEFAULT_varOutFileFolder:
-            cmd += "\"" + args.outputPath + "\""
+def getArgvTemplate(command, batch):
+
+    key = (command, ArgvTemplate, batch)
+    template = compiledTemplates.get(key)
+    if template is None:
+        if batch:
+            template = ArgvTemplate(command, getBatchArgumentRenderer,
+                                    getBatchArgumentListRenderer)
         else:
-            return None
+            template = ArgvTemplate(command, getArgumentRenderer)
+        compiledTemplates[key] = template
+
+    return template
+
 
-    if oneMatchFound:
-        cmd += args.command[m.end():]
+def generateArgv(inOutPair, args):
+
+    return getArgvTemplate(args.command, False).render(inOutPair,
+                                                       args.outputPath)
+
+
+def generateBatchArgv(inOutPairs, args):
+
+    return getArgvTemplate(args.command, True).render(inOutPairs,
+                                                      args.outputPath)
+
+
+def generateManifestCommand(inOutPair, args):
+
+    # the command recorded in the manifest for a pair. In batch mode the
+    # actual command depends on the other files of the batch, hence the
+    # command format is used instead
+    if args.func:
+        return args.func
+    elif args.batchSize > 1:
+        return args.command
+    elif args.noShell:
+        return formatArgv(generateArgv(inOutPair, args))
     else:
-        cmd = args.command
+        return generateCommand(inOutPair, args)
 
-    return cmd
 
+def formatArgv(argv):
 
-def generateCounter(counter, label):
-    counterStr = None
+    # a printable (and shell compatible) version of the arguments
+    return ' '.join(pipes.quote(a) for a in argv)
 
-    if not counter is None:
-        numberOfDigits = int(label[len(DEFAULT_varCounter):])
 
-        if numberOfDigits > 0:
-            counterStr = ('%0' + str(numberOfDigits) + 'd') % counter
-        else:
-            counterStr = str(counter)
+def getMaxBatchLength(args):
 
-    return counterStr
+    try:
+        argMax = os.sysconf('SC_ARG_MAX')
+    except (ValueError, OSError, AttributeError):
+        argMax = DEFAULT_maxArgumentLength
 
-def getCounterFromName(baseName, label):
-    counterStr = None
+    # without the shell only the total size of the arguments is limited
+    if args.noShell:
+        return argMax - len(args.command) - DEFAULT_argumentLengthMargin
 
-    regEx = re.compile('\d+')
-    match = regEx.search(baseName)
-    counter = int(match.group(0))
+    # leave room for the environment and for the rest of the command
+    return min(argMax, DEFAULT_maxArgumentLength) - len(args.command) - \
+        DEFAULT_argumentLengthMargin
 
-    if not counter is None:
-        numberOfDigits = int(label[len(DEFAULT_varOrigCounter):])
 
-        if numberOfDigits > 0:
-            counterStr = ('%0' + str(numberOfDigits) + 'd') % counter
-        else:
-            counterStr = str(counter)
+def batchInOutPairs(inOutPairs, args, flushDelay=0.0):
+
+    # group the pairs in chunks of at most args.batchSize pairs, making sure
+    # the expanded command does not exceed the system limits. When the
+    # source is idle (FEED_IDLE, passed on) the partial batch is sent once no
+    # pair arrived for flushDelay seconds
+    maxLength = getMaxBatchLength(args)
+    if args.noShell:
+        # every path is a NUL terminated argument plus its pointer
+        pathOverhead = 1 + struct.calcsize('P')
+    else:
+        # every path is quoted and separated by a space
+        pathOverhead = 3
+
+    batch = []
+    batchLength = 0
+    lastArrival = time.time()
+    for inOutPair in inOutPairs:
+        if inOutPair is FEED_IDLE:
+            if batch and time.time() - lastArrival >= flushDelay:
+                yield batch
+                batch = []
+                batchLength = 0
+            yield inOutPair
+            continue
+
+        lastArrival = time.time()
+        pairLength = len(inOutPair[0]) + pathOverhead
+        if inOutPair[1]:
+            pairLength += len(inOutPair[1]) + pathOverhead
 
-    return counterStr
+        if batch and batchLength + pairLength > maxLength:
+            yield batch
+            batch = []
+            batchLength = 0
+
+        batch.append(inOutPair)
+        batchLength += pairLength
+
+        # a full batch is sent right away, the next pair may be long to come
+        if len(batch) >= args.batchSize:
+            yield batch
+            batch = []
+            batchLength = 0
+
+    if batch:
+        yield batch
 
 
 def generateOutputFilename(filename, args, counter=None):
 
+    if args.nameFormat is None:
+        return None
+
     # decompose the input filename
     dirName, name = os.path.split(filename)
     baseName, extension = os.path.splitext(name)
 
-    if args.nameFormat is None:
-        # outputFilename = baseName + extension
-        outputFilename = None
-    else:
+    outputFilename = getTemplate(args.nameFormat, getNameRenderer).render(
+        baseName, extension, counter)
 
-        # detect all the matches to the format variables
-        matchIterator = generateMatchIterator(
-            VAR_REG_EX_FOR_NAME_FORMAT_COMPILED, args.nameFormat)
+    if outputFilename:
+        outputFilename = os.path.join(args.outputPath, outputFilename)
 
-        # and replace them with the corresponding value
-        outputFilename = ''
-        begin = 0
-        oneMatchFound = False
-        for m in matchIterator:
+    return outputFilename
 
-            oneMatchFound = True
 
-            outputFilename += args.nameFormat[begin:m.start()]
-            begin = m.end()
+# the record produced for each processed file. The output of a cached
+# file was copied from the cache and no command was run
+Result = collections.namedtuple('Result', ['input', 'output', 'command',
+                                           'status', 'wallTime',
+                                           'stdout', 'stderr',
+                                           'stdoutFilename', 'stderrFilename',
+                                           'queueWait', 'spawnTime',
+                                           'stdoutSize', 'stderrSize',
+                                           'cached'])
+
+
+class OutputCapture(object):
+
+    # keeps at most limit bytes of a stream in memory. If the stream is longer
+    # and a spool folder is given, the whole stream is written to a file in
+    # that folder, otherwise it is truncated
+    def __init__(self, limit, spoolFolder=None, spoolPrefix='', spoolSuffix=''):
+        self.limit = limit
+        self.size = 0
+        self.filename = None
+        self._spoolFolder = spoolFolder
+        self._spoolPrefix = spoolPrefix
+        self._spoolSuffix = spoolSuffix
+        self._head = []
+        self._headSize = 0
+        self._file = None
+
+    def write(self, data):
+        if self._file is None and self._spoolFolder and \
+                self.size + len(data) > self.limit:
+            self._openSpool()
+
+        if self._file is not None:
+            self._file.write(data)
+
+        room = self.limit - self._headSize
+        if room > 0:
+            self._head.append(data[:room])
+            self._headSize += min(room, len(data))
+
+        self.size += len(data)
+
+    def _openSpool(self):
+        if not os.path.isdir(self._spoolFolder):
+            try:
+                os.makedirs(self._spoolFolder)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        fd, self.filename = tempfile.mkstemp(prefix=self._spoolPrefix,
+                                             suffix=self._spoolSuffix,
+                                             dir=self._spoolFolder)
+        self._file = os.fdopen(fd, 'wb')
+        self._file.write(''.join(self._head))
+
+    def getText(self):
+        return ''.join(self._head)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def getSpoolFolder(args):
+
+    if args.spoolFolder:
+        return args.spoolFolder
+    elif args.logFilename:
+        return os.path.splitext(args.logFilename)[0] + '_output'
+    else:
+        return None
+
+
+def readOutputs(captures):
+
+    # drain the pipes as the data arrives, so that the command never blocks
+    # on a full pipe and the memory used per command stays bounded
+    poller = select.poll()
+    for fd in captures:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
 
-            # get the match
-            label = args.nameFormat[m.start() + len(DEFAULT_varPrefix) + 2:m.end() - 1]
-
-            if label == DEFAULT_varBaseName:
-                outputFilename += baseName
-            elif label == DEFAULT_varExtension:
-                outputFilename += extension
-            elif label[0:len(DEFAULT_varCounter)] == DEFAULT_varCounter:
-                counterStr = generateCounter(counter, label)
-                if counterStr:
-                    outputFilename += counterStr
-            elif label[0:len(DEFAULT_varOrigCounter)] == DEFAULT_varOrigCounter:
-                counterStr = getCounterFromName(baseName, label)
-                if counterStr:
-                    outputFilename += counterStr
+    while captures:
+        try:
+            events = poller.poll()
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd, event in events:
+            data = os.read(fd, DEFAULT_readSize)
+            if data:
+                captures[fd].write(data)
             else:
-                print 'The label', label, 'for the format of the output name is invalid'
-                sys.exit(ERROR_INVALID_NAME_FORMAT_LABEL)
+                poller.unregister(fd)
+                del captures[fd]
 
-        if oneMatchFound:
-            outputFilename += args.nameFormat[m.end():]
-        else:
-            outputFilename = args.nameFormat
 
-    if outputFilename:
-        outputFilename = os.path.join(args.outputPath, outputFilename)
+def startCommand(job, args):
 
-    return outputFilename
+    # when job.argv is set the command is executed directly, without the
+    # shell. If it cannot be executed no process is returned and the error is
+    # reported in the captured errors
+    spoolFolder = getSpoolFolder(args)
+    stdoutCapture = OutputCapture(args.outputLimit, spoolFolder,
+                                  job.spoolPrefix, '.stdout')
+    stderrCapture = OutputCapture(args.outputLimit, spoolFolder,
+                                  job.spoolPrefix, '.stderr')
+
+    start = time.time()
+    if job.argv is None:
+        proc = subprocess.Popen([job.cmd], shell=True, stdout=subprocess.
+                                PIPE, stderr=subprocess.PIPE, env=job.envDict)
+    else:
+        try:
+            proc = subprocess.Popen(job.argv, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, env=job.envDict)
+        except OSError, e:
+            stderrCapture.write(job.argv[0] + ': ' + e.strerror + '\n')
+            stderrCapture.close()
+            proc = None
+    job.spawnTime = time.time() - start
 
+    return proc, stdoutCapture, stderrCapture
 
-def worker(inOutPair, args, outputQueue):
 
-    if args.verbosity & VERBOSE_FILE_PROCESSOR:
-        if inOutPair[1]:
-            print Colors.FILE_PROCESSOR + 'Processing' + Colors.ENDC, inOutPair[0], Colors.FILE_PROCESSOR + ' -> ' + Colors.ENDC, inOutPair[1]
-        else:
-            print Colors.FILE_PROCESSOR + 'Processing' + Colors.ENDC, inOutPair[0], Colors.FILE_PROCESSOR
+def importFunction(spec):
+
+    # the callable of --func module:callable, the callable may be dotted
+    # (e.g. module:Class.method)
+    moduleName, separator, functionName = spec.partition(':')
+    if not separator or not moduleName or not functionName:
+        raise ValueError(spec + ' is not of the form module:callable')
+
+    __import__(moduleName)
+    function = sys.modules[moduleName]
+    for name in functionName.split('.'):
+        function = getattr(function, name)
+    if not callable(function):
+        raise ValueError(spec + ' is not callable')
+
+    return function
+
+
+def callFunction(function, envDict, captureOutput):
+
+    # the function gets the variables the commands get in their environment
+    # and returns the exit status (None for 0). An exception is a failure,
+    # whose traceback is the error output. The output can be captured only
+    # when a single call runs in the process
+    stdout = cStringIO.StringIO()
+    stderr = cStringIO.StringIO()
+    if captureOutput:
+        savedOutputs = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = stdout, stderr
+    try:
+        status = function(envDict)
+        status = 0 if status is None else int(status)
+    except Exception:
+        status = 1
+        traceback.print_exc(file=stderr)
+    finally:
+        if captureOutput:
+            sys.stdout, sys.stderr = savedOutputs
+
+    return status, stdout.getvalue(), stderr.getvalue()
+
+
+# the function of the processes of the pool, imported once per process
+pooledFunction = None
+
+
+def initializeFunctionPool(spec):
+
+    global pooledFunction
+    pooledFunction = importFunction(spec)
+
+
+def callPooledFunction(envDict):
+
+    return callFunction(pooledFunction, envDict, True)
+
+
+class FunctionRunner(object):
+
+    # calls the function of --func for each file: in a pool of processes
+    # (which suits CPU bound functions, and each process keeps its state
+    # between the calls), or directly in the threads of the dispatcher
+    # (which suits I/O bound functions). The function is imported in this
+    # process too, so that a wrong spec is reported before any file is
+    # processed
+    def __init__(self, spec, poolType, numberOfProcesses):
+        self.function = importFunction(spec)
+        self._pool = None
+        if poolType == FUNC_POOL_PROCESS:
+            self._pool = multiprocessing.Pool(numberOfProcesses,
+                                              initializeFunctionPool, (spec,))
+
+    def __call__(self, envDict):
+        if self._pool:
+            return self._pool.apply(callPooledFunction, (envDict,))
+        return callFunction(self.function, envDict, False)
+
+    def close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+
+
+functionRunners = {}
+
+
+def openFunctionRunner(args):
+
+    if not args.func:
+        return None
+
+    parallel = args.parallel and args.jobs > 1
+    try:
+        runner = FunctionRunner(args.func, args.funcPool,
+                                args.jobs if parallel else 1)
+    except (ImportError, AttributeError, ValueError), e:
+        raise FileProcessorError('Cannot load the function ' + args.func +
+                                 ': ' + str(e), ERROR_FUNCTION)
+
+    functionRunners[args.func] = runner
+    return runner
+
+
+def runFunction(job, args):
+
+    spoolFolder = getSpoolFolder(args)
+    stdoutCapture = OutputCapture(args.outputLimit, spoolFolder,
+                                  job.spoolPrefix, '.stdout')
+    stderrCapture = OutputCapture(args.outputLimit, spoolFolder,
+                                  job.spoolPrefix, '.stderr')
+
+    start = time.time()
+    status, stdout, stderr = functionRunners[args.func](job.envDict)
+    wallTime = time.time() - start
+
+    stdoutCapture.write(stdout)
+    stderrCapture.write(stderr)
+    stdoutCapture.close()
+    stderrCapture.close()
+
+    return status, wallTime, stdoutCapture, stderrCapture
+
+
+def runCommand(job, args):
+
+    if args.func:
+        return runFunction(job, args)
+
+    start = time.time()
+    proc, stdoutCapture, stderrCapture = startCommand(job, args)
+    if proc is None:
+        return DEFAULT_commandNotFoundStatus, time.time() - start, \
+            stdoutCapture, stderrCapture
+
+    try:
+        readOutputs({proc.stdout.fileno(): stdoutCapture,
+                     proc.stderr.fileno(): stderrCapture})
+    finally:
+        proc.stdout.close()
+        proc.stderr.close()
+        stdoutCapture.close()
+        stderrCapture.close()
+    proc.wait()
+    wallTime = time.time() - start
+
+    return proc.returncode, wallTime, stdoutCapture, stderrCapture
+
+
+def printProcessing(inOutPair):
+
+    if inOutPair[1]:
+        print Colors.FILE_PROCESSOR + 'Processing' + Colors.ENDC, inOutPair[0], Colors.FILE_PROCESSOR + ' -> ' + Colors.ENDC, inOutPair[1]
+    else:
+        print Colors.FILE_PROCESSOR + 'Processing' + Colors.ENDC, inOutPair[0], Colors.FILE_PROCESSOR
+
+
+def printOutputs(stdoutCapture, stderrCapture):
+
+    output = stdoutCapture.getText()
+    if stdoutCapture.size > len(output):
+        output += '\n[output truncated, ' + str(stdoutCapture.size) + ' bytes]'
+    print Colors.EXEC + output + Colors.ENDC
+
+    errors = stderrCapture.getText()
+    if errors:
+        print Colors.FAIL + errors + Colors.ENDC
+
+
+def generateEnvironment(inOutPair, args):
 
     folderName, name = os.path.split( inOutPair[0] )
     baseName, ext = os.path.splitext( name )
@@ -264,146 +1189,2304 @@ def worker(inOutPair, args, outputQueue):
     if inOutPair[1]:
         envDict[DEFAULT_varPrefix + DEFAULT_varOutFile] = inOutPair[1]
 
-    cmd = generateCommand(inOutPair, args)
+    return envDict
+
+
+class Job(object):
+
+    # a command to run on a single pair, or on a batch of pairs. When the
+    # shell is not used argv holds the arguments and cmd their printable form
+    def __init__(self, inOutPairs, cmd, envDict, inputStats, argv=None,
+                 queueWait=0.0):
+        self.inOutPairs = inOutPairs
+        self.cmd = cmd
+        self.argv = argv
+        self.envDict = envDict
+        self.inputStats = inputStats
+        self.spoolPrefix = os.path.basename(inOutPairs[0][0]) + '.'
+        self.queueWait = queueWait
+        self.spawnTime = None
+        self.cache = None
+        self.cacheKeys = {}
+
+
+def prepareJob(inOutPairs, args, batch, manifest=None, queueWait=0.0):
+
+    if args.verbosity & VERBOSE_FILE_PROCESSOR:
+        for inOutPair in inOutPairs:
+            printProcessing(inOutPair)
+
+    argv = None
+    if batch:
+        envDict = {DEFAULT_varPrefix + DEFAULT_varOutFileFolder: args.outputPath}
+        if args.noShell:
+            argv = generateBatchArgv(inOutPairs, args)
+        else:
+            cmd = generateBatchCommand(inOutPairs, args)
+    else:
+        envDict = generateEnvironment(inOutPairs[0], args)
+        if args.func:
+            cmd = args.func
+        elif args.noShell:
+            argv = generateArgv(inOutPairs[0], args)
+        else:
+            cmd = generateCommand(inOutPairs[0], args)
+
+    if argv is not None:
+        cmd = formatArgv(argv)
+
     if args.verbosity & VERBOSE_FILE_PROCESSOR_DEBUG:
         print Colors.FILE_PROCESSOR_DEBUG + 'Executing' + Colors.ENDC, cmd
 
-    proc = subprocess.Popen([cmd], shell=True, stdout=subprocess.
-                            PIPE, stderr=subprocess.PIPE, env=envDict)
-    output, errors = proc.communicate()
+    # stat the inputs before running the command, so that changes made while
+    # the command runs will trigger a new processing next time
+    inputStats = None
+    if manifest:
+        inputStats = [os.stat(p[0]) for p in inOutPairs]
+
+    return Job(inOutPairs, cmd, envDict, inputStats, argv, queueWait)
+
+
+def finishJob(job, status, wallTime, stdoutCapture, stderrCapture, args,
+              outputQueue, manifest=None):
+
+    if job.cache and status == 0:
+        for inOutPair in job.inOutPairs:
+            key = job.cacheKeys.get(inOutPair[0])
+            if key and os.path.isfile(inOutPair[1]):
+                try:
+                    job.cache.store(key, inOutPair[1])
+                except (IOError, OSError), e:
+                    print Colors.FAIL + 'Cannot cache', inOutPair[1] + ':', str(e) + Colors.ENDC
+
+    # the exit status of the command applies to every file of the batch
+    if manifest:
+        for inOutPair, inputStat in zip(job.inOutPairs, job.inputStats):
+            manifest.record(inOutPair[0], inputStat,
+                            generateManifestCommand(inOutPair, args), status)
+
+    # the output of the command (and its spawn time) is recorded only once
+    # per batch
+    for i, inOutPair in enumerate(job.inOutPairs):
+        if i == 0:
+            outputQueue.put(Result(inOutPair[0], inOutPair[1], job.cmd, status,
+                                   wallTime, stdoutCapture.getText(),
+                                   stderrCapture.getText(),
+                                   stdoutCapture.filename,
+                                   stderrCapture.filename,
+                                   job.queueWait, job.spawnTime,
+                                   stdoutCapture.size, stderrCapture.size,
+                                   False))
+        else:
+            outputQueue.put(Result(inOutPair[0], inOutPair[1], job.cmd, status,
+                                   wallTime, '', '', None, None,
+                                   job.queueWait, None, 0, 0, False))
 
-    outputQueue.put((proc, cmd, output, errors))
     if args.verbosity & VERBOSE_EXEC:
-        print Colors.EXEC + output + Colors.ENDC
-        if errors:
-            print Colors.FAIL + errors + Colors.ENDC
+        printOutputs(stdoutCapture, stderrCapture)
 
-def splitInputFilenames(s):
 
-    dir_name, name = os.path.split(s)
-    base, ext = os.path.splitext(name)
+def printCached(inOutPair):
 
-    # split the string into text and number substrings
-    components = [int(c) if c.isdigit() else c for c in re.split(
-        '([0-9]+)', base)]
+    print Colors.FILE_PROCESSOR + 'Cached' + Colors.ENDC, inOutPair[0], Colors.FILE_PROCESSOR + ' -> ' + Colors.ENDC, inOutPair[1]
 
-    # try to be smart:
-    # - ignore case
-    # - use number first and strings later
-    # - remove string composed only of spaces
-    strComponents = []
-    numComponents = []
-    for c in components:
+
+def serveFromCache(inOutPairs, args, outputQueue, manifest, cache,
+                   queueWait=0.0):
+
+    # the pairs whose output is in the cache are completed right away,
+    # without rendering (nor logging) the command. Returns the other pairs
+    # with their cache keys
+    remainingPairs = []
+    cacheKeys = {}
+    for inOutPair in inOutPairs:
+        if not inOutPair[1]:
+            remainingPairs.append(inOutPair)
+            continue
+
+        start = time.time()
         try:
-            cStripped = c.strip()
+            # stat the input before hashing it, as prepareJob does
+            inputStat = os.stat(inOutPair[0]) if manifest else None
+            key = cache.key(inOutPair, args)
+        except (IOError, OSError):
+            remainingPairs.append(inOutPair)
+            continue
+
+        if cache.fetch(key, inOutPair[1]):
+            if args.verbosity & VERBOSE_FILE_PROCESSOR:
+                printCached(inOutPair)
+            if manifest:
+                manifest.record(inOutPair[0], inputStat,
+                                generateManifestCommand(inOutPair, args), 0)
+            outputQueue.put(Result(inOutPair[0], inOutPair[1], None, 0,
+                                   time.time() - start, '', '', None, None,
+                                   queueWait, None, 0, 0, True))
+        else:
+            cache.unlinkShared(inOutPair[1])
+            cacheKeys[inOutPair[0]] = key
+            remainingPairs.append(inOutPair)
 
-            if len(cStripped):
-                strComponents.append(cStripped.lower())
-        except AttributeError:
-            numComponents.append(c)
+    return remainingPairs, cacheKeys
 
-    key = tuple(numComponents + strComponents)
 
-    return key
+def worker(inOutPair, args, outputQueue, manifest=None, queueWait=0.0,
+           cache=None):
 
+    cacheKeys = {}
+    if cache:
+        inOutPairs, cacheKeys = serveFromCache([inOutPair], args, outputQueue,
+                                               manifest, cache, queueWait)
+        if not inOutPairs:
+            return
 
-def run(args):
+    job = prepareJob([inOutPair], args, False, manifest, queueWait)
+    job.cache, job.cacheKeys = cache, cacheKeys
+    status, wallTime, stdoutCapture, stderrCapture = runCommand(job, args)
+    finishJob(job, status, wallTime, stdoutCapture, stderrCapture, args,
+              outputQueue, manifest)
 
-    # check input path
-    if not os.path.isdir(args.inputPath):
-        print Colors.FAIL + 'Error: the input path', args.inputPath, 'does not exist' + \
-            Colors.ENDC
-        sys.exit(ERROR_INPUT_PATH_DOES_NOT_EXIST)
 
-    # check if output path needs to be created
-    if not os.path.exists(args.outputPath):
-        os.makedirs(args.outputPath)
+def batchWorker(inOutPairs, args, outputQueue, manifest=None, queueWait=0.0,
+                cache=None):
+
+    cacheKeys = {}
+    if cache:
+        inOutPairs, cacheKeys = serveFromCache(inOutPairs, args, outputQueue,
+                                               manifest, cache, queueWait)
+        if not inOutPairs:
+            return
+
+    job = prepareJob(inOutPairs, args, True, manifest, queueWait)
+    job.cache, job.cacheKeys = cache, cacheKeys
+    status, wallTime, stdoutCapture, stderrCapture = runCommand(job, args)
+    finishJob(job, status, wallTime, stdoutCapture, stderrCapture, args,
+              outputQueue, manifest)
+
+def workerLoop(workQueue, target, args, outputQueue, manifest=None,
+               cache=None, controller=None):
+
+    # long lived worker: keep pulling work items (a pair or a batch of pairs)
+    # until the sentinel shows up
+    while True:
+        entry = workQueue.get()
+        try:
+            if entry is None:
+                return
+            item, enqueueTime = entry
+            if controller:
+                controller.acquire()
+            try:
+                target(item, args, outputQueue, manifest,
+                       time.time() - enqueueTime, cache)
+            except Exception, e:
+                print Colors.FAIL + 'Error while processing', str(item) + ':', str(e) + Colors.ENDC
+            finally:
+                if controller:
+                    controller.release()
+        finally:
+            workQueue.task_done()
+
+
+def dispatch(inOutPairs, args, outputQueue, manifest=None, target=worker,
+             cache=None, controller=None):
+
+    # a fixed number of threads pulls the pairs from a bounded work queue.
+    # Each thread launches its commands via subprocess, hence the memory
+    # footprint does not depend on the number of files to process
+    numberOfJobs = max(1, args.jobs)
+    workQueue = Queue.Queue(maxsize=2 * numberOfJobs)
+
+    workers = []
+    for i in xrange(numberOfJobs):
+        thread = threading.Thread(target=workerLoop,
+                                  args=(workQueue, target, args,
+                                        outputQueue, manifest, cache,
+                                        controller))
+        thread.daemon = True
+        workers.append(thread)
+        thread.start()
+
+    dispatched = False
+    try:
+        for p in inOutPairs:
+            if p is not FEED_IDLE:
+                workQueue.put((p, time.time()))
+        dispatched = True
+    finally:
+        # when interrupted the pairs not started yet are dropped, whereas the
+        # running commands (which got the interruption too) are waited for,
+        # so that nothing records their results once the sinks are closed
+        while not dispatched:
+            try:
+                workQueue.get_nowait()
+            except Queue.Empty:
+                break
+
+        for w in workers:
+            workQueue.put(None)
+
+        # join with a timeout so that the main thread stays responsive to
+        # CTRL+C
+        for w in workers:
+            while w.isAlive():
+                w.join(0.5)
+
+
+class RunningJob(object):
+
+    # the state of a command started by the event engine
+    def __init__(self, job, proc, stdoutCapture, stderrCapture, start):
+        self.job = job
+        self.proc = proc
+        self.stdoutCapture = stdoutCapture
+        self.stderrCapture = stderrCapture
+        self.start = start
+        self.openPipes = 2
+
+
+def raiseOpenFilesLimit(numberOfJobs):
+
+    # every running command keeps two pipes open
+    if resource is None:
+        return
+
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        needed = 2 * numberOfJobs + DEFAULT_openFilesMargin
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            if hard != resource.RLIM_INFINITY:
+                needed = min(needed, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+    except (ValueError, resource.error):
+        pass
+
+
+def eventDispatch(items, args, outputQueue, manifest=None, batch=False,
+                  cache=None, controller=None):
+
+    # a single thread keeps up to args.jobs commands running, waiting for
+    # their outputs with poll(). Since there is no thread (nor interpreter)
+    # per command, thousands of I/O bound commands can be in flight at once
+    numberOfJobs = max(1, args.jobs)
+    raiseOpenFilesLimit(numberOfJobs)
+
+    poller = select.poll()
+    fds = {}
+    runningJobs = 0
+    items = iter(items)
+    exhausted = False
+
+    while True:
+
+        # top up the running commands. An idle source stops the top up, the
+        # commands are then polled for a short while only
+        limit = controller.limit if controller else numberOfJobs
+        idle = False
+        while not exhausted and runningJobs < limit:
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+                break
+            if item is FEED_IDLE:
+                idle = True
+                break
+
+            inOutPairs = item if batch else [item]
+            try:
+                cacheKeys = {}
+                if cache:
+                    inOutPairs, cacheKeys = serveFromCache(
+                        inOutPairs, args, outputQueue, manifest, cache)
+                    if not inOutPairs:
+                        continue
+
+                job = prepareJob(inOutPairs, args, batch, manifest)
+                job.cache, job.cacheKeys = cache, cacheKeys
+                start = time.time()
+                proc, stdoutCapture, stderrCapture = startCommand(job, args)
+                if proc is None:
+                    finishJob(job, DEFAULT_commandNotFoundStatus,
+                              time.time() - start, stdoutCapture,
+                              stderrCapture, args, outputQueue, manifest)
+                    continue
+            except Exception, e:
+                print Colors.FAIL + 'Error while processing', inOutPairs[0][0] + ':', str(e) + Colors.ENDC
+                continue
+
+            runningJob = RunningJob(job, proc, stdoutCapture, stderrCapture,
+                                    start)
+            for pipe, capture in ((proc.stdout, stdoutCapture),
+                                  (proc.stderr, stderrCapture)):
+                fds[pipe.fileno()] = (pipe, capture, runningJob)
+                poller.register(pipe.fileno(), select.POLLIN | select.POLLPRI)
+            runningJobs += 1
+
+        if not runningJobs:
+            if exhausted:
+                break
+            continue
 
-    if args.fileFilter:
         try:
-            pattern = re.compile(args.fileFilter)
-        except:
-            print Colors.FAIL + 'The regular expression', args.fileFilter, 'is invalid' + \
-                Colors.ENDC
-            print Colors.FAIL + 'Sorry dude. You could be hitting on of these two bugs: http://bugs.python.org/issue2537 or http://bugs.python.org/issue214033' + Colors.ENDC
-            sys.exit(ERROR_INVALID_REGEX)
+            # the limit of the controller may grow while waiting
+            if idle:
+                events = poller.poll(DEFAULT_feedIdleInterval * 1000)
+            elif controller:
+                events = poller.poll(DEFAULT_adaptiveInterval * 1000)
+            else:
+                events = poller.poll()
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd, event in events:
+            pipe, capture, runningJob = fds[fd]
+            data = os.read(fd, DEFAULT_readSize)
+            if data:
+                capture.write(data)
+                continue
+
+            # end of stream
+            poller.unregister(fd)
+            del fds[fd]
+            pipe.close()
+            capture.close()
+            runningJob.openPipes -= 1
+            if runningJob.openPipes:
+                continue
+
+            runningJob.proc.wait()
+            runningJobs -= 1
+            if controller:
+                controller.completed += 1
+            try:
+                finishJob(runningJob.job, runningJob.proc.returncode,
+                          time.time() - runningJob.start,
+                          runningJob.stdoutCapture, runningJob.stderrCapture,
+                          args, outputQueue, manifest)
+            except Exception, e:
+                print Colors.FAIL + 'Error while processing', runningJob.job.inOutPairs[0][0] + ':', str(e) + Colors.ENDC
+
+
+def readMemoryUsage():
+
+    # the percentage of the physical memory in use, None if unknown
+    try:
+        values = {}
+        with open(DEFAULT_meminfoFilename) as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                values[name] = int(value.split()[0])
+        return 100.0 * (1.0 - float(values['MemAvailable']) / values['MemTotal'])
+    except (IOError, ValueError, KeyError, ZeroDivisionError):
+        return None
+
+
+class ConcurrencyController(object):
+
+    # the number of commands in flight, adjusted at run time between 1 and
+    # maximum (--jobs), where it starts. A thread samples the system every
+    # few seconds:
+    # - when the load average or the memory in use exceed their limits, the
+    #   number of commands is halved (at most once per cooldown, since the
+    #   load average lags)
+    # - otherwise, once the cooldown is over, it is doubled back towards
+    #   maximum, unless the previous increase made the throughput drop, in
+    #   which case it is undone
+    def __init__(self, maximum, maxLoad, maxMem, verbosity):
+        self.maximum = maximum
+        self.limit = maximum
+        self.maxLoad = maxLoad
+        self.maxMem = maxMem
+        self.verbosity = verbosity
+        self.completed = 0
+        self.running = 0
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def acquire(self):
+        with self._condition:
+            while self.running >= self.limit:
+                self._condition.wait(DEFAULT_adaptiveInterval)
+            self.running += 1
+
+    def release(self):
+        with self._condition:
+            self.running -= 1
+            self.completed += 1
+            self._condition.notify()
+
+    def _setLimit(self, limit, reason):
+        if limit == self.limit:
+            return
+
+        if self.verbosity & VERBOSE_FILE_PROCESSOR_DEBUG:
+            print Colors.FILE_PROCESSOR_DEBUG + 'Concurrency' + Colors.ENDC, self.limit, '->', limit, '(' + reason + ')'
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    def _run(self):
+        lastCompleted = 0
+        lastTime = time.time()
+        lastDecrease = 0.0
+        lastThroughput = None
+        previousLimit = None
+
+        while not self._stopped.wait(DEFAULT_adaptiveInterval):
+            now = time.time()
+            completed = self.completed
+            throughput = (completed - lastCompleted) / max(now - lastTime, 1e-6)
+            enoughSamples = completed - lastCompleted >= self.limit
+            lastCompleted, lastTime = completed, now
+
+            load = os.getloadavg()[0]
+            memory = readMemoryUsage()
+            if load > self.maxLoad or (memory is not None and
+                                       memory > self.maxMem):
+                if now - lastDecrease >= DEFAULT_adaptiveCooldown:
+                    self._setLimit(max(1, self.limit // 2),
+                                   'load %.2f, memory %s%%' % (load, memory and int(memory)))
+                    lastDecrease = now
+                previousLimit = None
+            elif previousLimit and enoughSamples and lastThroughput and \
+                    throughput < lastThroughput * (1 - DEFAULT_adaptiveTolerance):
+                self._setLimit(previousLimit,
+                               'throughput %.1f files/s' % throughput)
+                lastDecrease = now
+                previousLimit = None
+            elif self.limit < self.maximum and \
+                    now - lastDecrease >= DEFAULT_adaptiveCooldown:
+                previousLimit = self.limit
+                self._setLimit(min(self.maximum, self.limit * 2),
+                               'throughput %.1f files/s' % throughput)
+
+            if enoughSamples:
+                lastThroughput = throughput
+
+    def close(self):
+        self._stopped.set()
+        while self._thread.isAlive():
+            self._thread.join(0.5)
+
+
+def startController(args):
+
+    if not args.adaptive or not (args.parallel or
+                                 args.engine == ENGINE_EVENT):
+        return None
+
+    return ConcurrencyController(max(1, args.jobs), args.maxLoad,
+                                 args.maxMem, args.verbosity)
+
+
+def orderBySize(inOutPairs):
+
+    # longest processing time first: the largest inputs are started first,
+    # so that the run does not end waiting for a large file started last.
+    # The counters have been assigned already, hence the names do not change
+    def size(inOutPair):
+        try:
+            return os.path.getsize(inOutPair[0])
+        except OSError:
+            return 0
+
+    return sorted(inOutPairs, key=size, reverse=True)
+
+
+def percentile(sortedValues, fraction):
+
+    if not sortedValues:
+        return 0.0
+
+    return sortedValues[int(round(fraction * (len(sortedValues) - 1)))]
+
+
+class Stats(object):
+
+    # collects the duration of the phases of run() and the per file timings
+    # reported by the workers. The per file latencies are stored in compact
+    # arrays of doubles, and only the slowest files are kept
+    def __init__(self, numberOfWorkers, top):
+        self.numberOfWorkers = numberOfWorkers
+        self.top = top
+        self.start = time.time()
+        self.end = None
+        self._lock = threading.Lock()
+        self._phases = collections.OrderedDict()
+        self._innerPhases = {}
+        self._wallTimes = array.array('d')
+        self._spawnTimes = array.array('d')
+        self._queueWaits = array.array('d')
+        self._slowest = []
+        self._busyTime = 0.0
+        self._statuses = collections.Counter()
+
+    def addPhase(self, phase, seconds, innerPhase=None):
+        with self._lock:
+            self._phases[phase] = self._phases.get(phase, 0.0) + seconds
+            if innerPhase:
+                self._innerPhases[phase] = innerPhase
+
+    def timeIterator(self, phase, iterable, innerPhase=None):
+        # the time spent producing each item is charged to the phase. Since
+        # the iterators are chained, the time of the inner phase is removed
+        # when the summary is computed
+        self.addPhase(phase, 0.0, innerPhase)
+        return self._timeIterator(phase, iterable)
+
+    def _timeIterator(self, phase, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.addPhase(phase, time.time() - start)
+                return
+            self.addPhase(phase, time.time() - start)
+            yield item
+
+    def __call__(self, result):
+        with self._lock:
+            self._wallTimes.append(result.wallTime)
+            self._queueWaits.append(result.queueWait)
+            self._statuses[result.status] += 1
+            if result.spawnTime is not None:
+                self._spawnTimes.append(result.spawnTime)
+                self._busyTime += result.wallTime
+
+            entry = (result.wallTime, result.input)
+            if self.top <= 0:
+                pass
+            elif len(self._slowest) < self.top:
+                heapq.heappush(self._slowest, entry)
+            elif entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def close(self):
+        self.end = time.time()
+
+    def summary(self):
+        end = self.end or time.time()
+        elapsed = end - self.start
+        phases = collections.OrderedDict()
+        for phase, seconds in self._phases.items():
+            innerPhase = self._innerPhases.get(phase)
+            if innerPhase:
+                seconds -= self._phases.get(innerPhase, 0.0)
+            phases[phase] = max(seconds, 0.0)
+
+        wallTimes = sorted(self._wallTimes)
+        spawnTimes = sorted(self._spawnTimes)
+        queueWaits = sorted(self._queueWaits)
+        numberOfFiles = len(wallTimes)
+        dispatchTime = self._phases.get('dispatch', elapsed)
+
+        return {'elapsed': elapsed,
+                'files': numberOfFiles,
+                'failed': numberOfFiles - self._statuses.get(0, 0),
+                'filesPerSecond': numberOfFiles / elapsed if elapsed else 0.0,
+                'phases': phases,
+                'latency': dict(('p%d' % (100 * p), percentile(wallTimes, p))
+                                for p in (0.5, 0.95, 0.99)),
+                'spawnLatency': dict(('p%d' % (100 * p), percentile(spawnTimes, p))
+                                     for p in (0.5, 0.95, 0.99)),
+                'queueWait': dict(('p%d' % (100 * p), percentile(queueWaits, p))
+                                  for p in (0.5, 0.95, 0.99)),
+                'workers': self.numberOfWorkers,
+                'workerUtilization': self._busyTime / (self.numberOfWorkers * dispatchTime)
+                if dispatchTime else 0.0,
+                'exitStatuses': dict((str(k), v) for k, v in self._statuses.items()),
+                'slowest': [{'input': i, 'wallTime': t} for t, i in
+                            sorted(self._slowest, reverse=True)]}
+
+    def printSummary(self, summary):
+        print Colors.FILE_PROCESSOR + 'Statistics' + Colors.ENDC
+        print '  files: %d (%d failed) in %.3f s, %.1f files/s' % (
+            summary['files'], summary['failed'], summary['elapsed'],
+            summary['filesPerSecond'])
+        for phase, seconds in summary['phases'].items():
+            print '  %-12s %10.3f s' % (phase, seconds)
+        for name in ('latency', 'spawnLatency', 'queueWait'):
+            print '  %-12s p50 %.4f s  p95 %.4f s  p99 %.4f s' % (
+                name, summary[name]['p50'], summary[name]['p95'],
+                summary[name]['p99'])
+        print '  utilization %.1f%% of %d workers' % (
+            100 * summary['workerUtilization'], summary['workers'])
+        if summary['slowest']:
+            print '  slowest files:'
+            for entry in summary['slowest']:
+                print '    %10.4f s %s' % (entry['wallTime'], entry['input'])
+
+
+def timed(stats, phase, iterable, innerPhase=None):
+
+    if stats is None:
+        return iterable
+
+    return stats.timeIterator(phase, iterable, innerPhase)
+
+
+class CsvLog(object):
+
+    # writes one row per processed file
+    def __init__(self, filename):
+        self._file = open(filename, 'wb')
+        self._lastFlush = time.time()
+        self._writer = csv.writer(
+            self._file, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
+        self._writer.writerow(('# input', 'output', 'exit status', 'wall time',
+                               'command', 'stdout', 'stderr', 'stdout file',
+                               'stderr file', 'cached'))
+
+    def __call__(self, result):
+        self._writer.writerow((result.input, result.output, result.status,
+                               '%.6f' % result.wallTime, result.command,
+                               result.stdout, result.stderr,
+                               result.stdoutFilename, result.stderrFilename,
+                               int(result.cached)))
+        if time.time() - self._lastFlush >= DEFAULT_logFlushInterval:
+            self._file.flush()
+            self._lastFlush = time.time()
+
+    def close(self):
+        self._file.close()
+
+
+def toText(value):
+
+    # the paths and the outputs are byte strings, in UTF-8 most of the time
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class JsonLinesLog(object):
+
+    # writes one JSON object per processed file, in batches. The outputs of
+    # the command are included only when not empty, their sizes always
+    def __init__(self, filename):
+        self._file = open(filename, 'wb')
+        self._pending = []
+        self._lastFlush = time.time()
+
+    def __call__(self, result):
+        record = {'input': toText(result.input),
+                  'output': toText(result.output),
+                  'command': toText(result.command),
+                  'status': result.status,
+                  'wallTime': result.wallTime,
+                  'queueWait': result.queueWait,
+                  'spawnTime': result.spawnTime,
+                  'stdoutSize': result.stdoutSize,
+                  'stderrSize': result.stderrSize,
+                  'cached': result.cached}
+        for name in ('stdout', 'stderr', 'stdoutFilename', 'stderrFilename'):
+            value = getattr(result, name)
+            if value:
+                record[name] = toText(value)
+
+        self._pending.append(json.dumps(record) + '\n')
+        if len(self._pending) >= DEFAULT_logBatchSize or \
+                time.time() - self._lastFlush >= DEFAULT_logFlushInterval:
+            self._flush()
+
+    def _flush(self):
+        self._file.write(''.join(self._pending))
+        self._file.flush()
+        self._pending = []
+        self._lastFlush = time.time()
+
+    def close(self):
+        self._flush()
+        self._file.close()
+
+
+class SqliteLog(object):
+
+    # writes one row per processed file in a SQLite database, inserted in
+    # batches. The indexes used by the queries are created at the end, which
+    # is faster than maintaining them while inserting
+    def __init__(self, filename):
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.text_factory = str
+        self._connection.execute('PRAGMA synchronous=OFF')
+        self._connection.execute('DROP TABLE IF EXISTS results')
+        self._connection.execute('CREATE TABLE results ('
+                                 'input TEXT, '
+                                 'output TEXT, '
+                                 'command TEXT, '
+                                 'status INTEGER, '
+                                 'wallTime REAL, '
+                                 'queueWait REAL, '
+                                 'spawnTime REAL, '
+                                 'stdoutSize INTEGER, '
+                                 'stderrSize INTEGER, '
+                                 'stdout TEXT, '
+                                 'stderr TEXT, '
+                                 'stdoutFilename TEXT, '
+                                 'stderrFilename TEXT, '
+                                 'cached INTEGER)')
+        self._connection.commit()
+        self._pending = []
+        self._lastFlush = time.time()
+
+    def __call__(self, result):
+        self._pending.append((result.input, result.output, result.command,
+                              result.status, result.wallTime,
+                              result.queueWait, result.spawnTime,
+                              result.stdoutSize, result.stderrSize,
+                              result.stdout, result.stderr,
+                              result.stdoutFilename, result.stderrFilename,
+                              int(result.cached)))
+        if len(self._pending) >= DEFAULT_logBatchSize or \
+                time.time() - self._lastFlush >= DEFAULT_logFlushInterval:
+            self._flush()
+
+    def _flush(self):
+        self._connection.executemany('INSERT INTO results VALUES '
+                                     '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                     self._pending)
+        self._connection.commit()
+        self._pending = []
+        self._lastFlush = time.time()
+
+    def close(self):
+        self._flush()
+        self._connection.execute('CREATE INDEX results_status ON results (status)')
+        self._connection.execute('CREATE INDEX results_wallTime ON results (wallTime)')
+        self._connection.commit()
+        self._connection.close()
+
+
+def openLog(args):
+
+    if args.logFormat == LOG_JSONL:
+        return JsonLinesLog(args.logFilename)
+    elif args.logFormat == LOG_SQLITE:
+        return SqliteLog(args.logFilename)
     else:
-        pattern = None
+        return CsvLog(args.logFilename)
 
-    # check if we do need to recurse or not
-    inputFilenames = []
-    if args.recursive:
 
-        for dirname, dirnames, filenames in os.walk(args.inputPath):
-            for filename in filenames:
-                if not pattern or pattern.search(filename):
-                    inputFilenames.append(os.path.join(dirname, filename))
+def readLogRecords(filename):
 
+    # the (input, output, status, wall time) of the files of a CSV or JSON
+    # Lines log, read one at a time
+    with open(filename, 'rb') as f:
+        if f.read(1) == '{':
+            f.seek(0)
+            for line in f:
+                record = json.loads(line)
+                yield (record['input'].encode('utf-8'),
+                       (record['output'] or u'').encode('utf-8'),
+                       record['status'], record['wallTime'])
+        else:
+            f.seek(0)
+            csv.field_size_limit(sys.maxsize)
+            reader = csv.reader(f, delimiter=',', quotechar='"')
+            next(reader, None)
+            for row in reader:
+                yield row[0], row[1], int(row[2]), float(row[3])
+
+
+def isSqliteLog(filename):
+
+    with open(filename, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def queryLog(filename, failures=False, slowest=None):
+
+    # the records of the failed files, of the slowest files, or of all the
+    # files. The SQLite logs are queried through their indexes, the others
+    # are streamed (the slowest files are kept in a bounded heap)
+    if isSqliteLog(filename):
+        connection = sqlite3.connect(filename)
+        connection.text_factory = str
+        try:
+            sql = 'SELECT input, output, status, wallTime FROM results'
+            if failures:
+                sql += ' WHERE status != 0'
+            if slowest:
+                sql += ' ORDER BY wallTime DESC LIMIT %d' % slowest
+            for record in connection.execute(sql):
+                yield record
+        finally:
+            connection.close()
+        return
+
+    records = readLogRecords(filename)
+    if failures:
+        records = (r for r in records if r[2] != 0)
+    if slowest:
+        records = heapq.nlargest(slowest, records, key=operator.itemgetter(3))
+    for record in records:
+        yield record
+
+
+def summarizeLog(filename):
+
+    numberOfFiles = failed = 0
+    wallTime = 0.0
+    for inputFilename, outputFilename, status, seconds in queryLog(filename):
+        numberOfFiles += 1
+        failed += status != 0
+        wallTime += seconds or 0.0
+
+    return numberOfFiles, failed, wallTime
+
+
+class Journal(object):
+
+    # the files completed successfully, one JSON string per line, appended
+    # as the results come in. The file is synced in batches: a crash loses
+    # at most the last batch, whose files are then processed again. A
+    # truncated last line is ignored when the journal is read back
+    def __init__(self, filename, resume):
+        self.filename = filename
+        self.completed = set()
+        if resume and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        self.completed.add(json.loads(line))
+                    except ValueError:
+                        break
+
+        # a fresh run starts a new journal, a resumed one rewrites the
+        # completed files, so that a truncated tail does not linger
+        self._file = open(filename, 'wb')
+        for inputFilename in self.completed:
+            self._file.write(json.dumps(inputFilename) + '\n')
+        self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._lastSync = time.time()
+
+    def __call__(self, result):
+        if result.status != 0:
+            return
+
+        self._file.write(json.dumps(os.path.abspath(result.input)) + '\n')
+        self._pending += 1
+        if self._pending >= DEFAULT_journalBatchSize or \
+                time.time() - self._lastSync >= DEFAULT_journalSyncInterval:
+            self._sync()
+
+    def close(self):
+        self._sync()
+        self._file.close()
+
+
+class ResultCollector(object):
+
+    # a thread draining the results while the jobs are running and handing
+    # them to the sinks (e.g. the log). The queue is bounded, hence the
+    # workers slow down rather than piling up results in memory
+    def __init__(self, sinks):
+        self.queue = Queue.Queue(maxsize=DEFAULT_resultQueueSize)
+        self._sinks = sinks
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            result = self.queue.get()
+            if result is None:
+                return
+
+            for sink in self._sinks:
+                try:
+                    sink(result)
+                except Exception, e:
+                    print Colors.FAIL + 'Error while recording the result for', result.input + ':', str(e) + Colors.ENDC
+
+    def close(self):
+        self.queue.put(None)
+        while self._thread.isAlive():
+            self._thread.join(0.5)
+
+        for sink in self._sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+
+def splitInputFilenames(s):
+
+    # the human friendly key of the base name, computed in one pass:
+    # - ignore case
+    # - use number first and strings later
+    # - remove string composed only of spaces
+    # The base name is extracted as os.path.splitext() does, without its
+    # overhead
+    name = s[s.rfind(os.sep) + 1:]
+    dot = name.rfind('.')
+    if dot > 0 and name[:dot].lstrip('.'):
+        name = name[:dot]
+
+    # split the string into text and number substrings: the numbers are the
+    # odd components
+    components = NUMBERS_REG_EX_COMPILED.split(name)
+    numComponents = [int(c) for c in components[1::2]]
+    strComponents = [c.lower() for c in
+                     (c.strip() for c in components[0::2]) if c]
+
+    return tuple(numComponents + strComponents)
+
+
+def humanSortKey(s):
+
+    # the folder comes first (so that the files of a folder stay together) and
+    # the full name breaks the ties, hence the order is deterministic
+    return (s[:s.rfind(os.sep) + 1], splitInputFilenames(s), s)
+
+
+def getSortKey(args):
+
+    # the key applied to the discovered entries: file names, or (file name,
+    # stat) pairs for the modes relying on the stat data (see needsStat())
+    if args.sortMode == SORT_HUMAN:
+        return humanSortKey
+    elif args.sortMode == SORT_MTIME:
+        return lambda e: (e[1].st_mtime, e[0])
+    elif args.sortMode == SORT_SIZE:
+        return lambda e: (e[1].st_size, e[0])
+
+    return None
+
+
+def needsStat(args):
+
+    return args.sortMode in (SORT_MTIME, SORT_SIZE)
+
+
+def readRun(runFile):
+
+    runFile.seek(0)
+    while True:
+        try:
+            yield marshal.load(runFile)
+        except EOFError:
+            return
+
+
+def externalSort(entries, key, filenameOf, maxInMemory):
+
+    # sorts chunks of at most maxInMemory entries, spills them to temporary
+    # files as (key, file name) records and merges them lazily
+    runFiles = []
+    chunk = []
+    try:
+        for entry in entries:
+            chunk.append((key(entry), filenameOf(entry)))
+            if len(chunk) >= maxInMemory:
+                chunk.sort()
+                runFile = tempfile.TemporaryFile(prefix='fileProcessorSort')
+                for record in chunk:
+                    marshal.dump(record, runFile)
+                runFiles.append(runFile)
+                chunk = []
+
+        chunk.sort()
+        runs = [readRun(f) for f in runFiles] + [iter(chunk)]
+        for record in heapq.merge(*runs):
+            yield record[1]
+    finally:
+        for runFile in runFiles:
+            runFile.close()
+
+
+def compileFileFilter(args):
+
+    if not args.fileFilter:
+        return None
+
+    try:
+        return re.compile(args.fileFilter)
+    except:
+        raise FileProcessorError('The regular expression ' + args.fileFilter + ' is invalid\n' +
+                                 'Sorry dude. You could be hitting on of these two bugs: http://bugs.python.org/issue2537 or http://bugs.python.org/issue214033',
+                                 ERROR_INVALID_REGEX)
+
+
+def compileDirectoryFilter(regEx, option):
+
+    if not regEx:
+        return None
+
+    try:
+        return re.compile(regEx)
+    except:
+        raise FileProcessorError('The regular expression ' + regEx + ' given to ' +
+                                 option + ' is invalid', ERROR_INVALID_REGEX)
+
+
+def compileGlobs(globs):
+
+    # all the glob patterns are merged in a single regular expression
+    if not globs:
+        return None
+
+    return re.compile('|'.join('(?:' + fnmatch.translate(g) + ')'
+                               for g in globs))
+
+
+def scanDirectory(dirName, withStat=False):
+
+    # yields (name, isFile, isDir, stat) for the entries of a folder. When
+    # scandir is available the file type comes for free with the directory
+    # listing, otherwise we fall back to one lstat per entry (plus one stat to
+    # follow the symbolic links). The symbolic links to folders are not
+    # followed. The stat of the files is provided only if withStat is set
+    if scandir is None:
+        prefix = os.path.join(dirName, '')
+        for name in os.listdir(dirName):
+            try:
+                fileStat = os.lstat(prefix + name)
+                if stat.S_ISLNK(fileStat.st_mode):
+                    fileStat = os.stat(prefix + name)
+                    yield name, stat.S_ISREG(fileStat.st_mode), False, fileStat
+                else:
+                    yield name, stat.S_ISREG(fileStat.st_mode), \
+                        stat.S_ISDIR(fileStat.st_mode), fileStat
+            except OSError:
+                continue
     else:
+        for entry in scandir(dirName):
+            try:
+                isDir = entry.is_dir() and not entry.is_symlink()
+                isFile = not isDir and entry.is_file()
+                fileStat = entry.stat() if withStat and isFile else None
+                yield entry.name, isFile, isDir, fileStat
+            except OSError:
+                continue
+
+
+class DirectoryWalker(object):
+
+    # walks the input folder listing each folder once. The file type comes
+    # from the directory entries, the file filters (regular expression and
+    # globs) are applied to the file names, and the folders rejected by the
+    # folder filters or deeper than maxDepth are pruned without being listed.
+    # When sortFiles is set the files are sorted (by sortKey) within their
+    # folder, and the subfolders are visited in lexicographical order. When
+    # withStat is set (file name, stat) pairs are produced instead of names,
+    # reusing the stat data of the directory entries. The files of
+    # fileProcessor itself (whose names start with the internal prefix, or
+    # whose absolute names are in excludedFiles) are never produced
+    def __init__(self, args, pattern, sortFiles=False, sortKey=None,
+                 withStat=False, excludedFiles=()):
+        self.inputPath = args.inputPath
+        self.recursive = args.recursive
+        self.maxDepth = args.maxDepth
+        self.numberOfThreads = args.walkThreads
+        self.sortFiles = sortFiles
+        self.sortKey = sortKey
+        self.withStat = withStat
+        self.excludedFiles = frozenset(excludedFiles)
+        self._pattern = pattern
+        self._globs = compileGlobs(args.glob)
+        self._dirInclude = compileDirectoryFilter(args.dirInclude, '--dirInclude')
+        self._dirExclude = compileDirectoryFilter(args.dirExclude, '--dirExclude')
+
+    def listDirectory(self, dirName, depth):
+        # returns the (filtered) files and the subfolders to visit
+        descend = self.recursive and \
+            (self.maxDepth is None or depth < self.maxDepth)
+        prefix = os.path.join(dirName, '')
+        absolutePrefix = os.path.join(os.path.abspath(dirName), '')
+
+        inputFilenames = []
+        subDirNames = []
+        for name, isFile, isDir, fileStat in scanDirectory(dirName,
+                                                           self.withStat):
+            if isDir:
+                if descend and \
+                        (not self._dirInclude or self._dirInclude.search(name)) and \
+                        (not self._dirExclude or not self._dirExclude.search(name)):
+                    subDirNames.append(prefix + name)
+            elif isFile and \
+                    (not self._pattern or self._pattern.search(name)) and \
+                    (not self._globs or self._globs.match(name)) and \
+                    not name.startswith(DEFAULT_internalPrefix) and \
+                    absolutePrefix + name not in self.excludedFiles:
+                if self.withStat:
+                    inputFilenames.append((prefix + name, fileStat))
+                else:
+                    inputFilenames.append(prefix + name)
+
+        if self.sortFiles:
+            inputFilenames.sort(key=self.sortKey)
+            subDirNames.sort()
+
+        return inputFilenames, subDirNames
+
+    def acceptsFile(self, name):
+        return (not self._pattern or self._pattern.search(name)) and \
+            (not self._globs or self._globs.match(name))
+
+    def acceptsFolder(self, name, depth):
+        # whether a subfolder of a folder at the given depth is visited
+        return self.recursive and \
+            (self.maxDepth is None or depth < self.maxDepth) and \
+            (not self._dirInclude or self._dirInclude.search(name)) and \
+            (not self._dirExclude or not self._dirExclude.search(name))
+
+    def __iter__(self):
+        if self.numberOfThreads > 1:
+            return self._walkInParallel()
+        else:
+            return self._walk()
+
+    def _walk(self):
+        # depth first, the stack is LIFO hence the folders are pushed in
+        # reverse order
+        pendingDirs = [(self.inputPath, 0)]
+        while pendingDirs:
+            dirName, depth = pendingDirs.pop()
+            try:
+                inputFilenames, subDirNames = self.listDirectory(dirName, depth)
+            except OSError, e:
+                print Colors.FAIL + 'Cannot list the folder', dirName + ':', str(e) + Colors.ENDC
+                continue
+
+            for inputFilename in inputFilenames:
+                yield inputFilename
+
+            for subDirName in reversed(subDirNames):
+                pendingDirs.append((subDirName, depth + 1))
+
+    def _walkInParallel(self):
+        # a pool of threads lists the folders concurrently, which hides the
+        # latency of each listing on network file systems. The files of a
+        # folder are yielded together, but the folders come in no given order
+        dirQueue = Queue.Queue()
+        fileQueue = Queue.Queue(maxsize=DEFAULT_walkQueueSize)
+        lock = threading.Lock()
+        pending = [1]
+
+        def walker():
+            while True:
+                entry = dirQueue.get()
+                if entry is None:
+                    return
+
+                dirName, depth = entry
+                try:
+                    inputFilenames, subDirNames = self.listDirectory(dirName, depth)
+                except OSError, e:
+                    print Colors.FAIL + 'Cannot list the folder', dirName + ':', str(e) + Colors.ENDC
+                    inputFilenames, subDirNames = [], []
+
+                if inputFilenames:
+                    fileQueue.put(inputFilenames)
+
+                with lock:
+                    pending[0] += len(subDirNames) - 1
+                    done = pending[0] == 0
+                for subDirName in subDirNames:
+                    dirQueue.put((subDirName, depth + 1))
+                if done:
+                    fileQueue.put(None)
+
+        threads = []
+        for i in xrange(self.numberOfThreads):
+            thread = threading.Thread(target=walker)
+            thread.daemon = True
+            threads.append(thread)
+            thread.start()
+
+        dirQueue.put((self.inputPath, 0))
+        try:
+            while True:
+                inputFilenames = fileQueue.get()
+                if inputFilenames is None:
+                    break
+                for inputFilename in inputFilenames:
+                    yield inputFilename
+        finally:
+            for thread in threads:
+                dirQueue.put(None)
+
+
+def listInputFilenames(args, pattern, excludedFiles=()):
+
+    # the discovered entries: file names, or (file name, stat) pairs when the
+    # sorting mode needs them
+    return DirectoryWalker(args, pattern, withStat=needsStat(args),
+                           excludedFiles=excludedFiles)
+
+
+def walkInputFilenames(args, pattern, excludedFiles=()):
+
+    # generator counterpart of listInputFilenames(): each file is yielded as
+    # soon as its folder is listed. When a sorting mode is set the files are
+    # sorted within their folder, so that the memory footprint is bounded by
+    # the size of the largest folder
+    withStat = needsStat(args)
+    walker = DirectoryWalker(args, pattern, args.sortMode != SORT_NONE,
+                             getSortKey(args), withStat, excludedFiles)
+    if withStat:
+        return (e[0] for e in walker)
+    else:
+        return iter(walker)
+
 
-        for item in os.listdir(args.inputPath):
-            inputFilename = os.path.join(args.inputPath, item)
-            if os.path.isfile(inputFilename) and (not pattern or pattern.search(inputFilename)):
-                inputFilenames.append(inputFilename)
+def sortInputFilenames(entries, args):
 
     # sort the input list in a human friendly manner
     # see http://nedbatchelder.com/blog/200712/human_sorting.html
-    if args.sortMode == SORT_LEXICOGRAPHICAL:
-        inputFilenames = sorted(inputFilenames)
-    elif args.sortMode == SORT_HUMAN:
-        inputFilenames = sorted(inputFilenames, key=splitInputFilenames)
+    # Returns a list, or an iterator when the external sort is used
+    withStat = needsStat(args)
+    filenameOf = operator.itemgetter(0) if withStat else lambda f: f
+
+    if args.sortMode == SORT_NONE:
+        return [filenameOf(e) for e in entries]
+
+    key = getSortKey(args)
+    if args.sortMemory:
+        return externalSort(entries, key or filenameOf, filenameOf,
+                            args.sortMemory)
+
+    return [filenameOf(e) for e in sorted(entries, key=key)]
+
+
+def generateInOutPairs(inputFilenames, args):
 
     # form the I/O pairs
-    inOutPairs = []
     counter = args.counterOffset
     absoluteCounter = 0
     for inputFilename in inputFilenames:
         if absoluteCounter % args.samplingStep == 0:
             outputFilename = generateOutputFilename(inputFilename, args, counter)
-            inOutPair = (inputFilename, outputFilename)
-            inOutPairs.append(inOutPair)
+            yield (inputFilename, outputFilename)
 
         absoluteCounter += 1
         counter += 1
 
-    if args.verbosity & VERBOSE_FILE_PROCESSOR:
-        print Colors.FILE_PROCESSOR + 'Processing' + Colors.ENDC, str(
-            len(inOutPairs)), Colors.FILE_PROCESSOR + 'files' + Colors.ENDC
 
-    # spawn the jobs
-    if args.parallel:
-        outputQueue = multiprocessing.Queue()
-        jobs = []
-        for p in inOutPairs:
-            process = multiprocessing.Process(
-                target=worker, args=(p, args, outputQueue))
-            jobs.append(process)
-            process.start()
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 00004000
+IN_CLOEXEC = 02000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def loadInotify():
+
+    # the inotify functions of the C library, None if not available
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (ImportError, OSError, AttributeError):
+        return None
+
+
+class DirectoryWatcher(object):
+
+    # the files appearing in the input folder after the initial discovery.
+    # The folders are watched with inotify, or polled when it is not
+    # available: only the folders whose modification time changed are listed
+    # again. A new file is a candidate until it stays unchanged (size and
+    # modification time) for settle seconds, so that the files being written
+    # are not processed half way. The watcher is set up before the initial
+    # discovery, hence no file is missed: follow() chains the initial files
+    # with the new ones, skipping the duplicates and the outputs. A file is
+    # known by its name, inode and modification time, so a file replaced or
+    # rewritten under the same name is processed again, and it is forgotten
+    # when it is deleted or moved away
+    def __init__(self, args, pattern, cancelled=None, excludedFiles=()):
+        self.settle = args.watchSettle
+        self.cancelled = cancelled
+        self.verbosity = args.verbosity
+        self.seen = {}
+        self.outputs = set()
+        self._walker = DirectoryWalker(args, pattern,
+                                       excludedFiles=excludedFiles)
+        self._candidates = {}
+        self._depths = {}
+        self._mtimes = {}
+        self._watches = {}
+        self._fd = None
+        self._stopped = threading.Event()
+
+        libc = None if args.watchPolling else loadInotify()
+        if libc:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._libc = libc
+                self._fd = fd
+                self._poller = select.poll()
+                self._poller.register(fd, select.POLLIN)
+
+        self._addFolder(self._walker.inputPath, 0, False)
+
+    def _addFolder(self, dirName, depth, scanFiles):
+        # watch a folder and its subfolders. The files of the folders
+        # created after the start are candidates, since they may have been
+        # created before the watch
+        pendingDirs = [(dirName, depth)]
+        while pendingDirs:
+            dirName, depth = pendingDirs.pop()
+            if dirName in self._depths:
+                continue
+
+            if self._fd is not None:
+                wd = self._libc.inotify_add_watch(
+                    self._fd, dirName, IN_CREATE | IN_MODIFY |
+                    IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM)
+                if wd < 0:
+                    continue
+                self._watches[wd] = dirName
+            else:
+                try:
+                    self._mtimes[dirName] = os.stat(dirName).st_mtime
+                except OSError:
+                    continue
+            self._depths[dirName] = depth
+
+            try:
+                inputFilenames, subDirNames = self._walker.listDirectory(
+                    dirName, depth)
+            except OSError:
+                continue
+
+            if scanFiles:
+                self._scanFiles(dirName, inputFilenames)
+            for subDirName in subDirNames:
+                pendingDirs.append((subDirName, depth + 1))
+
+    def _isSeen(self, fullName, fileStat):
+        # seen maps the absolute folders to {name: (inode, mtime)}
+        dirName, name = os.path.split(fullName)
+        return self.seen.get(dirName, {}).get(name) == \
+            (fileStat.st_ino, fileStat.st_mtime)
+
+    def _see(self, fullName, fileStat):
+        dirName, name = os.path.split(fullName)
+        self.seen.setdefault(dirName, {})[name] = \
+            (fileStat.st_ino, fileStat.st_mtime)
+
+    def _forget(self, inputFilename):
+        self._candidates.pop(inputFilename, None)
+        dirName, name = os.path.split(os.path.abspath(inputFilename))
+        names = self.seen.get(dirName)
+        if names is not None:
+            names.pop(name, None)
+            if not names:
+                del self.seen[dirName]
+
+    def _touch(self, inputFilename):
+        if os.path.basename(inputFilename).startswith(DEFAULT_internalPrefix):
+            return
+
+        fullName = os.path.abspath(inputFilename)
+        if fullName in self.outputs or fullName in self._walker.excludedFiles:
+            return
+        try:
+            if self._isSeen(fullName, os.stat(inputFilename)):
+                return
+        except OSError:
+            self._forget(inputFilename)
+            return
+        self._candidates.setdefault(inputFilename, None)
+
+    def _scanFiles(self, dirName, inputFilenames):
+        # the files listed again are candidates, the missing ones are
+        # forgotten
+        for inputFilename in inputFilenames:
+            self._touch(inputFilename)
+
+        names = self.seen.get(os.path.abspath(dirName))
+        if names:
+            present = set(os.path.basename(f) for f in inputFilenames)
+            for name in names.keys():
+                if name not in present:
+                    self._forget(os.path.join(dirName, name))
+
+    def _readEvents(self):
+        try:
+            if not self._poller.poll(DEFAULT_watchInterval * 1000):
+                return
+            data = os.read(self._fd, DEFAULT_inotifyReadSize)
+        except (OSError, select.error), e:
+            if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                return
+            raise
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost: the watched folders are listed again
+                for dirName, depth in self._depths.items():
+                    del self._depths[dirName]
+                    self._addFolder(dirName, depth, True)
+                continue
+
+            dirName = self._watches.get(wd)
+            if dirName is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                self._depths.pop(dirName, None)
+                self.seen.pop(os.path.abspath(dirName), None)
+            elif mask & IN_ISDIR:
+                depth = self._depths[dirName]
+                if self._walker.acceptsFolder(name, depth):
+                    self._addFolder(os.path.join(dirName, name), depth + 1,
+                                    True)
+            elif not self._walker.acceptsFile(name):
+                continue
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._forget(os.path.join(dirName, name))
+            else:
+                self._touch(os.path.join(dirName, name))
+
+    def _poll(self):
+        self._stopped.wait(DEFAULT_watchInterval)
+
+        for dirName, mtime in self._mtimes.items():
+            try:
+                currentMtime = os.stat(dirName).st_mtime
+            except OSError:
+                del self._mtimes[dirName]
+                del self._depths[dirName]
+                self.seen.pop(os.path.abspath(dirName), None)
+                continue
+            if currentMtime == mtime:
+                continue
+
+            self._mtimes[dirName] = currentMtime
+            try:
+                inputFilenames, subDirNames = self._walker.listDirectory(
+                    dirName, self._depths[dirName])
+            except OSError:
+                continue
+            self._scanFiles(dirName, inputFilenames)
+            for subDirName in subDirNames:
+                if subDirName not in self._depths:
+                    self._addFolder(subDirName, self._depths[dirName] + 1,
+                                    True)
+
+    def _settledFiles(self):
+        now = time.time()
+        settled = []
+        for inputFilename, state in self._candidates.items():
+            try:
+                fileStat = os.stat(inputFilename)
+            except OSError:
+                del self._candidates[inputFilename]
+                continue
+
+            key = (fileStat.st_size, fileStat.st_mtime)
+            if state is None or state[0] != key:
+                self._candidates[inputFilename] = (key, now)
+            elif now - state[1] >= self.settle:
+                del self._candidates[inputFilename]
+                settled.append((inputFilename, fileStat))
+
+        return settled
+
+    def __iter__(self):
+        if self.verbosity & VERBOSE_FILE_PROCESSOR:
+            print Colors.FILE_PROCESSOR + 'Watching' + Colors.ENDC, self._walker.inputPath, \
+                Colors.FILE_PROCESSOR + ('with inotify' if self._fd is not None else 'by polling') + Colors.ENDC
 
-        for j in jobs:
-            j.join()
+        try:
+            while not self._stopped.isSet() and \
+                    not (self.cancelled and self.cancelled.isSet()):
+                if self._fd is not None:
+                    self._readEvents()
+                else:
+                    self._poll()
+
+                for inputFilename, fileStat in self._settledFiles():
+                    fullName = os.path.abspath(inputFilename)
+                    if fullName in self.outputs or \
+                            self._isSeen(fullName, fileStat):
+                        continue
+                    self._see(fullName, fileStat)
+                    yield inputFilename
+        finally:
+            self.close()
+
+    def stop(self):
+        # the iteration ends within DEFAULT_watchInterval
+        self._stopped.set()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def follow(self, inputFilenames):
+        for inputFilename in inputFilenames:
+            try:
+                self._see(os.path.abspath(inputFilename),
+                          os.stat(inputFilename))
+            except OSError:
+                pass
+            yield inputFilename
+
+        for inputFilename in self:
+            yield inputFilename
+
+    def recordOutputs(self, inOutPairs):
+        # the outputs written in the watched folder are not inputs
+        for inOutPair in inOutPairs:
+            if inOutPair[1]:
+                self.outputs.add(os.path.abspath(inOutPair[1]))
+            yield inOutPair
+
+
+def skipUpToDatePairs(inOutPairs, args, manifest):
+
+    # the pairs are filtered after the counters have been assigned, so that
+    # the output names do not depend on which files are skipped
+    for inOutPair in inOutPairs:
+        inputFilename, outputFilename = inOutPair
+        try:
+            inputStat = os.stat(inputFilename)
+        except OSError:
+            continue
+
+        if outputFilename:
+            try:
+                if os.stat(outputFilename).st_mtime >= inputStat.st_mtime:
+                    continue
+            except OSError:
+                pass
+
+        if manifest.isUpToDate(inputFilename, inputStat,
+                               generateManifestCommand(inOutPair, args)):
+            continue
+
+        if args.verbosity & VERBOSE_FILE_PROCESSOR_DEBUG:
+            print Colors.FILE_PROCESSOR_DEBUG + 'Out of date' + Colors.ENDC, inputFilename
+
+        yield inOutPair
+
+
+def openManifest(args):
 
+    if not args.incremental:
+        return None
+
+    manifestFilename = args.manifest
+    if manifestFilename is None:
+        manifestFilename = os.path.join(args.outputPath,
+                                        DEFAULT_manifestFilename)
+
+    try:
+        return Manifest(manifestFilename, args.manifestHash)
+    except sqlite3.Error, e:
+        raise FileProcessorError('Cannot open the manifest ' + manifestFilename +
+                                 ': ' + str(e), ERROR_MANIFEST)
+
+
+def compileTemplates(args):
+
+    # parse the name format and the command once, so that invalid labels are
+    # detected before any file is processed
+    if args.nameFormat is not None:
+        try:
+            getTemplate(args.nameFormat, getNameRenderer)
+        except TemplateLabelError, e:
+            raise FileProcessorError('The label ' + e.label + ' for the format of the output name is invalid',
+                                     ERROR_INVALID_NAME_FORMAT_LABEL)
+
+    if args.func:
+        return
+
+    batch = args.batchSize > 1
+    if batch:
+        getRenderer = getBatchCommandRenderer
+        requiredLabel = DEFAULT_varInFileList
     else:
-        outputQueue = Queue.Queue()
-        for p in inOutPairs:
-            worker(p, args, outputQueue)
-
-    # produce the log file
-    if args.logFilename:
-        fOut = open(args.logFilename, 'wb')
-        writer = csv.writer(
-            fOut, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-        writer.writerow(('# command', 'stdout', 'stderr'))
-        while not outputQueue.empty():
-            writer.writerow((outputQueue.get()[1],
-                             outputQueue.get()[2], outputQueue.get()[3]))
-        fOut.close()
+        getRenderer = getCommandRenderer
+        requiredLabel = None
 
-if __name__ == "__main__":
+    try:
+        if args.noShell:
+            template = getArgvTemplate(args.command, batch)
+        else:
+            template = getTemplate(args.command, getRenderer)
+    except TemplateLabelError, e:
+        raise FileProcessorError('The label ' + e.label + ' for the command is invalid',
+                                 ERROR_INVALID_COMMAND_FORMAT_LABEL)
+    except ValueError, e:
+        raise FileProcessorError('The command cannot be split in its arguments: ' + str(e),
+                                 ERROR_COMMAND_PARSING)
+    except ProgramNotFoundError, e:
+        raise FileProcessorError('The program ' + e.program + ' of the command cannot be found in the PATH',
+                                 ERROR_PROGRAM_NOT_FOUND)
+
+    if requiredLabel and requiredLabel not in template.labels:
+        raise FileProcessorError('The command must contain the ' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + requiredLabel + '} label when the --batchSize option is set',
+                                 ERROR_INVALID_COMMAND_FORMAT_LABEL)
+
+    # the workers of a coordinator get the output names from it
+    if args.nameFormat is None and not args.connect and \
+            (DEFAULT_varOutFile in template.labels or
+             DEFAULT_varOutFileList in template.labels):
+        raise FileProcessorError('The command refers to the output files, but no name format was specified',
+                                 ERROR_INVALID_COMMAND_FORMAT_LABEL)
+
+
+def openJournal(args):
+
+    if not args.journal and not args.resume:
+        return None
+
+    journalFilename = args.journalFile
+    if journalFilename is None:
+        journalFilename = os.path.join(args.outputPath,
+                                       DEFAULT_journalFilename)
+
+    try:
+        return Journal(journalFilename, args.resume)
+    except (IOError, OSError), e:
+        raise FileProcessorError('Cannot open the journal ' + journalFilename +
+                                 ': ' + str(e), ERROR_JOURNAL)
+
+
+def internalFiles(args, manifest, journal):
+
+    # the absolute names of the files written by fileProcessor, which may lie
+    # in the input folder under any name
+    filenames = set()
+    if manifest:
+        filenames.update(manifest.files())
+    if journal:
+        filenames.add(os.path.abspath(journal.filename))
+    for filename in (args.logFilename, args.statsFile):
+        if filename:
+            filenames.update(os.path.abspath(filename + suffix)
+                             for suffix in ('', '-journal'))
+
+    return filenames
+
+
+def skipCompletedPairs(inOutPairs, args, journal):
+
+    # as for the manifest, the pairs are filtered after the counters have
+    # been assigned, so that a resumed run renders the same output names
+    for inOutPair in inOutPairs:
+        if os.path.abspath(inOutPair[0]) in journal.completed:
+            if args.verbosity & VERBOSE_FILE_PROCESSOR_DEBUG:
+                print Colors.FILE_PROCESSOR_DEBUG + 'Completed' + Colors.ENDC, inOutPair[0]
+            continue
+
+        yield inOutPair
+
+
+def parseShard(value):
+
+    # --shard K/N, with 1 <= K <= N
+    try:
+        index, count = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not of the form K/N' % value)
+
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('%s is not a valid shard: K must be between 1 and N' % value)
+
+    return index, count
+
+
+def shardPairs(inOutPairs, args):
+
+    # keep the pairs of this shard. The shard of a file depends on the hash of
+    # its path relative to the input path only, so that the nodes agree even
+    # if they mount the tree in different places. As for the manifest, the
+    # pairs are filtered after the counters have been assigned
+    index, count = args.shard
+    prefix = os.path.join(args.inputPath, '')
+    for inOutPair in inOutPairs:
+        inputFilename = inOutPair[0]
+        if inputFilename.startswith(prefix):
+            relativeFilename = inputFilename[len(prefix):]
+        else:
+            relativeFilename = os.path.relpath(inputFilename, args.inputPath)
+
+        if int(hashlib.sha1(relativeFilename).hexdigest()[:8], 16) % count == index - 1:
+            yield inOutPair
+
+
+def toByteStrings(value):
+
+    # JSON decodes to unicode, whereas the paths are byte strings
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    elif isinstance(value, list):
+        return [toByteStrings(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((toByteStrings(k), toByteStrings(v))
+                    for k, v in value.iteritems())
+    return value
+
+
+def encodeMessage(message):
+
+    # the messages between the coordinator and the workers are JSON lines.
+    # The byte strings go through latin-1, which maps every byte to a code
+    # point, hence any path (or output) survives the round trip
+    return json.dumps(message, encoding='latin-1') + '\n'
+
+
+def decodeMessage(line):
+
+    return toByteStrings(json.loads(line))
+
+
+def parseAddress(address):
+
+    # host:port for TCP, otherwise the path of a Unix socket
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit() and os.sep not in address:
+        return socket.AF_INET, (host or 'localhost', int(port))
+
+    return socket.AF_UNIX, address
+
+
+class Coordinator(object):
+
+    # hands out leases of pairs to the workers connected to it (--connect)
+    # and collects their results. The idle workers pull the next lease,
+    # hence the fast nodes process more files than the slow ones. The pairs
+    # leased to a worker that disconnects are handed out again
+    def __init__(self, inOutPairs, leaseSize, outputQueue):
+        self._inOutPairs = iter(inOutPairs)
+        self._leaseSize = leaseSize
+        self._outputQueue = outputQueue
+        self._lock = threading.Lock()
+        self._requeued = collections.deque()
+        self._outstanding = 0
+        self._exhausted = False
+        self.done = threading.Event()
+        self.connections = 0
+
+    def _checkDone(self):
+        if self._exhausted and not self._requeued and not self._outstanding:
+            self.done.set()
+
+    def lease(self):
+        with self._lock:
+            inOutPairs = []
+            while self._requeued and len(inOutPairs) < self._leaseSize:
+                inOutPairs.append(self._requeued.popleft())
+
+            if not self._exhausted and len(inOutPairs) < self._leaseSize:
+                inOutPairs.extend(itertools.islice(
+                    self._inOutPairs, self._leaseSize - len(inOutPairs)))
+                if len(inOutPairs) < self._leaseSize:
+                    self._exhausted = True
+
+            self._outstanding += len(inOutPairs)
+            self._checkDone()
+            return inOutPairs
+
+    def complete(self, results):
+        for result in results:
+            self._outputQueue.put(result)
+
+        with self._lock:
+            self._outstanding -= len(results)
+            self._checkDone()
+
+    def release(self, inOutPairs):
+        with self._lock:
+            self._requeued.extend(inOutPairs)
+            self._outstanding -= len(inOutPairs)
+            self._checkDone()
+
+
+class CoordinatorHandler(SocketServer.StreamRequestHandler):
+
+    # one connected worker: each message carries the results of the worker
+    # and possibly asks for a new lease
+    def handle(self):
+        coordinator = self.server.coordinator
+        leased = {}
+        with coordinator._lock:
+            coordinator.connections += 1
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+
+                message = decodeMessage(line)
+                results = []
+                for values in message['results']:
+                    result = Result(*values)
+                    if leased.pop(result.input, None) is not None:
+                        results.append(result)
+                coordinator.complete(results)
+
+                inOutPairs = []
+                if message['lease']:
+                    inOutPairs = coordinator.lease()
+                    for inOutPair in inOutPairs:
+                        leased[inOutPair[0]] = inOutPair
+
+                self.wfile.write(encodeMessage({
+                    'pairs': inOutPairs, 'done': coordinator.done.isSet()}))
+                self.wfile.flush()
+        except (IOError, socket.error, ValueError), e:
+            print Colors.FAIL + 'Lost a worker:', str(e) + Colors.ENDC
+        finally:
+            if leased:
+                coordinator.release(leased.values())
+            with coordinator._lock:
+                coordinator.connections -= 1
+
+
+class CoordinatorTCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class CoordinatorUnixServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serveInOutPairs(inOutPairs, args, outputQueue):
+
+    # the coordinator side of --coordinator: returns once all the pairs
+    # have been processed by the workers
+    family, address = parseAddress(args.coordinator)
+    try:
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.unlink(address)
+            server = CoordinatorUnixServer(address, CoordinatorHandler)
+        else:
+            server = CoordinatorTCPServer(address, CoordinatorHandler)
+    except (IOError, OSError, socket.error), e:
+        raise FileProcessorError('Cannot listen on ' + args.coordinator + ': ' +
+                                 str(e), ERROR_COORDINATOR)
+
+    coordinator = Coordinator(inOutPairs, args.leaseSize, outputQueue)
+    server.coordinator = coordinator
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    if args.verbosity & VERBOSE_FILE_PROCESSOR:
+        print Colors.FILE_PROCESSOR + 'Waiting for the workers on' + Colors.ENDC, args.coordinator
+
+    try:
+        # wait() with a timeout, so that the main thread can be interrupted.
+        # Once done, the workers still connected are told so when they poll
+        while not coordinator.done.isSet():
+            coordinator.done.wait(DEFAULT_coordinatorPollInterval)
+        while coordinator.connections:
+            time.sleep(DEFAULT_coordinatorPollInterval / 10)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+
+
+class CoordinatorClient(object):
+
+    # the worker side of --connect: pulls the pairs from the coordinator and,
+    # as a result sink, reports the results back with the next request
+    def __init__(self, address):
+        family, address = parseAddress(address)
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.connect(address)
+        # the commands must not inherit the connection, otherwise a lost
+        # worker stays connected (with its pairs leased) while they run
+        if fcntl:
+            flags = fcntl.fcntl(self._socket.fileno(), fcntl.F_GETFD)
+            fcntl.fcntl(self._socket.fileno(), fcntl.F_SETFD,
+                        flags | fcntl.FD_CLOEXEC)
+        self._rfile = self._socket.makefile('rb')
+        self._wfile = self._socket.makefile('wb')
+        self._lock = threading.Lock()
+        self._results = []
+        self._stopped = threading.Event()
+
+    def _request(self, lease):
+        with self._lock:
+            results, self._results = self._results, []
+
+        self._wfile.write(encodeMessage({'results': results, 'lease': lease}))
+        self._wfile.flush()
+        line = self._rfile.readline()
+        if not line:
+            raise IOError('the coordinator closed the connection')
+
+        return decodeMessage(line)
+
+    def pairs(self):
+        # asks again while the coordinator has pairs leased to other workers,
+        # since they may disconnect and their pairs be handed out again. The
+        # results of this worker go with each request, hence this runs in a
+        # PairFeeder: the worker completes its own pairs meanwhile
+        while not self._stopped.isSet():
+            reply = self._request(True)
+            if reply['pairs']:
+                for inOutPair in reply['pairs']:
+                    yield tuple(inOutPair)
+            elif reply['done']:
+                return
+            else:
+                self._stopped.wait(DEFAULT_coordinatorPollInterval)
+
+    def stop(self):
+        self._stopped.set()
+
+    def __call__(self, result):
+        with self._lock:
+            self._results.append(list(result))
+
+    def close(self):
+        try:
+            self._request(False)
+        finally:
+            self._socket.close()
+
+
+def connectToCoordinator(args):
+
+    try:
+        return CoordinatorClient(args.connect)
+    except (IOError, socket.error), e:
+        raise FileProcessorError('Cannot connect to the coordinator ' +
+                                 args.connect + ': ' + str(e), ERROR_COORDINATOR)
+
+
+class PairFeeder(object):
+
+    # runs a source of pairs that may block for long (the coordinator, the
+    # watcher) in a thread of its own. The dispatchers read the pairs from a queue and get
+    # FEED_IDLE when none arrived for a while, hence they keep completing
+    # their commands, and send their partial batches, while the source waits
+    def __init__(self, inOutPairs):
+        self._queue = Queue.Queue(maxsize=DEFAULT_feedQueueSize)
+        self._stopped = threading.Event()
+        self._failure = None
+        self._thread = threading.Thread(target=self._run, args=(inOutPairs,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        # put() with a timeout, so that a stopped feeder does not stay
+        # blocked on a full queue
+        while not self._stopped.isSet():
+            try:
+                self._queue.put(item, True, DEFAULT_feedIdleInterval)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self, inOutPairs):
+        try:
+            for inOutPair in inOutPairs:
+                if not self._put(inOutPair):
+                    return
+        except Exception:
+            self._failure = sys.exc_info()
+        finally:
+            self._put(None)
+
+    def __iter__(self):
+        while True:
+            try:
+                inOutPair = self._queue.get(True, DEFAULT_feedIdleInterval)
+            except Queue.Empty:
+                yield FEED_IDLE
+                continue
+
+            if inOutPair is None:
+                if self._failure:
+                    raise self._failure[0], self._failure[1], self._failure[2]
+                return
+            yield inOutPair
+
+    def close(self):
+        # the source must have been stopped, or be exhausted
+        self._stopped.set()
+        while self._thread.isAlive():
+            self._thread.join(0.5)
+
+
+def stopWhenCancelled(items, cancelled):
+
+    # the items not dispatched yet are dropped once the run is cancelled,
+    # the commands already running complete
+    for item in items:
+        if cancelled.isSet():
+            return
+        yield item
+
+
+def run(args, sinks=(), cancelled=None):
+
+    # the sinks are called with each Result, in addition to the ones set by
+    # the options (log, statistics, ...), and the run stops dispatching the
+    # files once the cancelled event is set
+
+    # check input path
+    if not os.path.isdir(args.inputPath):
+        raise FileProcessorError('Error: the input path ' + args.inputPath +
+                                 ' does not exist',
+                                 ERROR_INPUT_PATH_DOES_NOT_EXIST)
+
+    # check if output path needs to be created
+    if not os.path.exists(args.outputPath):
+        os.makedirs(args.outputPath)
+
+    compileTemplates(args)
+    pattern = compileFileFilter(args)
+
+    # everything opened from here on is closed on the way out, even when the
+    # run stops half way
+    manifest = journal = functionRunner = watcher = None
+    client = feeder = collector = controller = None
+    sinks = list(sinks)
+    try:
+        manifest = openManifest(args)
+        cache = openCache(args)
+        journal = openJournal(args)
+        if journal and journal.completed and \
+                args.verbosity & VERBOSE_FILE_PROCESSOR:
+            print Colors.FILE_PROCESSOR + 'Resuming' + Colors.ENDC, str(
+                len(journal.completed)), Colors.FILE_PROCESSOR + 'files already completed' + Colors.ENDC
+
+        # the processes of the function pool are started once the options
+        # are known to be valid
+        functionRunner = openFunctionRunner(args)
+
+        # the files written by fileProcessor are never inputs
+        excludedFiles = internalFiles(args, manifest, journal)
+
+        stats = None
+        if args.stats or args.statsFile:
+            parallel = args.parallel or args.engine == ENGINE_EVENT
+            stats = Stats(max(1, args.jobs) if parallel else 1, args.statsTop)
+
+        # set up before the discovery, so that no file is missed
+        if args.watch and not args.connect:
+            watcher = DirectoryWatcher(args, pattern, cancelled, excludedFiles)
+
+        if args.connect:
+            # the pairs come from the coordinator, which did the discovery and
+            # named the outputs
+            client = connectToCoordinator(args)
+            inOutPairs = client.pairs()
+            lastPhase = None
+        elif args.stream:
+            # discovery, name generation and execution are chained generators:
+            # the first command starts as soon as the first file is found
+            inputFilenames = timed(stats, 'discovery',
+                                   walkInputFilenames(args, pattern,
+                                                      excludedFiles))
+            if watcher:
+                inputFilenames = watcher.follow(inputFilenames)
+            inOutPairs = timed(stats, 'pairs',
+                               generateInOutPairs(inputFilenames, args),
+                               'discovery')
+            lastPhase = 'pairs'
+            if watcher:
+                inOutPairs = watcher.recordOutputs(inOutPairs)
+            if args.shard:
+                inOutPairs = timed(stats, 'shard', shardPairs(inOutPairs, args),
+                                   lastPhase)
+                lastPhase = 'shard'
+            if journal and journal.completed:
+                inOutPairs = timed(stats, 'resume',
+                                   skipCompletedPairs(inOutPairs, args, journal),
+                                   lastPhase)
+                lastPhase = 'resume'
+            if manifest:
+                inOutPairs = timed(stats, 'filter',
+                                   skipUpToDatePairs(inOutPairs, args, manifest),
+                                   lastPhase)
+                lastPhase = 'filter'
+        else:
+            if args.sortMemory:
+                # the external sort merges the sorted runs lazily, hence the
+                # pairs are not listed either
+                inputFilenames = timed(stats, 'discovery',
+                                       listInputFilenames(args, pattern,
+                                                          excludedFiles))
+                inputFilenames = timed(stats, 'sort',
+                                       sortInputFilenames(inputFilenames, args),
+                                       'discovery')
+                lastPhase = 'sort'
+            else:
+                start = time.time()
+                inputFilenames = list(listInputFilenames(args, pattern,
+                                                         excludedFiles))
+                if stats:
+                    stats.addPhase('discovery', time.time() - start)
+
+                start = time.time()
+                inputFilenames = sortInputFilenames(inputFilenames, args)
+                if stats:
+                    stats.addPhase('sort', time.time() - start)
+                lastPhase = None
+
+            # the new files follow the initial ones, the counters go on
+            if watcher:
+                inputFilenames = watcher.follow(inputFilenames)
+            inOutPairs = timed(stats, 'pairs',
+                               generateInOutPairs(inputFilenames, args), lastPhase)
+            lastPhase = 'pairs'
+            if watcher:
+                inOutPairs = watcher.recordOutputs(inOutPairs)
+            if args.shard:
+                inOutPairs = timed(stats, 'shard', shardPairs(inOutPairs, args),
+                                   lastPhase)
+                lastPhase = 'shard'
+            if journal and journal.completed:
+                inOutPairs = timed(stats, 'resume',
+                                   skipCompletedPairs(inOutPairs, args, journal),
+                                   lastPhase)
+                lastPhase = 'resume'
+            if manifest:
+                inOutPairs = timed(stats, 'filter',
+                                   skipUpToDatePairs(inOutPairs, args, manifest),
+                                   lastPhase)
+                lastPhase = 'filter'
+
+            if not args.sortMemory and not watcher:
+                inOutPairs = list(inOutPairs)
+                lastPhase = None
+
+                if args.largestFirst:
+                    start = time.time()
+                    inOutPairs = orderBySize(inOutPairs)
+                    if stats:
+                        stats.addPhase('order', time.time() - start)
+
+                if args.verbosity & VERBOSE_FILE_PROCESSOR:
+                    print Colors.FILE_PROCESSOR + 'Processing' + Colors.ENDC, str(
+                        len(inOutPairs)), Colors.FILE_PROCESSOR + 'files' + Colors.ENDC
+
+        if args.logFilename:
+            sinks.append(openLog(args))
+        if stats:
+            sinks.append(stats)
+        if journal:
+            sinks.append(journal)
+        if client:
+            sinks.append(client)
+        collector = ResultCollector(sinks)
+        outputQueue = collector.queue
+
+        # the coordinator may keep a worker waiting for pairs leased to
+        # others, the watcher waits for new files
+        if client or (watcher and not args.coordinator):
+            feeder = PairFeeder(inOutPairs)
+            inOutPairs = iter(feeder)
+
+        # spawn the jobs
+        target = worker
+        if args.batchSize > 1 and not args.coordinator:
+            # a watcher may be idle for long: its partial batch is sent once
+            # no new file settled for a while
+            flushDelay = args.watchSettle if watcher else 0.0
+            inOutPairs = timed(stats, 'batch',
+                               batchInOutPairs(inOutPairs, args, flushDelay),
+                               lastPhase)
+            lastPhase = 'batch'
+            target = batchWorker
+
+        if cancelled:
+            inOutPairs = stopWhenCancelled(inOutPairs, cancelled)
+
+        controller = startController(args)
+        start = time.time()
+        if args.coordinator:
+            serveInOutPairs(inOutPairs, args, outputQueue)
+        elif args.engine == ENGINE_EVENT:
+            eventDispatch(inOutPairs, args, outputQueue, manifest,
+                          args.batchSize > 1, cache, controller)
+        elif args.parallel:
+            dispatch(inOutPairs, args, outputQueue, manifest, target, cache,
+                     controller)
+        else:
+            for p in inOutPairs:
+                if p is not FEED_IDLE:
+                    target(p, args, outputQueue, manifest, 0.0, cache)
+        if stats:
+            stats.addPhase('dispatch', time.time() - start, lastPhase)
+    finally:
+        if controller:
+            controller.close()
+        if functionRunner:
+            functionRunner.close()
+        if feeder:
+            for source in (client, watcher):
+                if source:
+                    source.stop()
+            feeder.close()
+        if watcher:
+            watcher.close()
+
+        # closing the collector closes the sinks, the journal and the client
+        # among them
+        if collector:
+            collector.close()
+        else:
+            for sink in (journal, client):
+                if sink:
+                    sink.close()
+        if manifest:
+            manifest.close()
+
+    if stats:
+        summary = stats.summary()
+        if args.stats:
+            stats.printSummary(summary)
+        if args.statsFile:
+            with open(args.statsFile, 'w') as f:
+                json.dump(summary, f, indent=2)
+
+def createParser():
 
     descriptionStr = 'Process a set of files applying a command to each of them.'
 
     epilogStr = 'Notes.\n'
+    epilogStr += '\n- The log written by --logFilename can be searched with: %(prog)s query LOG [--failures] [--slowest [N]]\n'
     epilogStr += '\n- The string containing variables should be enclosed between SINGLE QUOTES (\') in order to avoid bash expansion.\n'
     epilogStr += '\n- The name format convenience variables available are the following.\n'
     epilogStr += '  -' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varBaseName + '} indicates the basename of the input file.\n'
@@ -417,6 +3500,9 @@ if __name__ == "__main__":
     epilogStr += '  -' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varInFileExtension + '} the extension of the input file\n'
     epilogStr += '  -' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varOutFile + '} the full name of the output file (provided it was created)\n'
     epilogStr += '  -' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varOutFileFolder + '} the folder for the output\n'
+    epilogStr += '\n- When the --batchSize option is set the command is applied to many files at once, and the following variables can be used in the command (instead of ' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varInFile + '} and ' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varOutFile + '}).\n'
+    epilogStr += '  -' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varInFileList + '} the quoted names of the input files, separated by spaces\n'
+    epilogStr += '  -' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varOutFileList + '} the quoted names of the output files, separated by spaces\n'
     epilogStr += '\nExample:\n\n'
     epilogStr += 'fileProcessor ./myInputFolder -o ./myOutputFolder -f \'(\\.bin)\\b\' -n \'${FP_BASENAME}_processed${FP_EXTENSION}\' -c \'myCommand ${FP_IN} ${FP_OUT}\' -r\n\n'
     epilogStr += 'The command myCommand will be applied to all the .bin files in the folder myInputFolder and its subfolders.\n'
@@ -439,11 +3525,53 @@ if __name__ == "__main__":
                          default=None,
                          required=False)
 
+    parser.add_argument('-g', '--glob',
+                         type=str,
+                         action='append',
+                         help='glob pattern (e.g. \'*.jpg\') the names of the input files must match. It can be given several times, in which case a file is processed if it matches any of them. It is combined with the --fileFilter regular expression. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--dirInclude',
+                         type=str,
+                         action='store',
+                         help='regular expression the names of the subfolders must match to be visited when recursing. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--dirExclude',
+                         type=str,
+                         action='store',
+                         help='regular expression defining the names of the subfolders that are not visited (with all their content) when recursing. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--maxDepth',
+                         type=int,
+                         action='store',
+                         help='maximum depth of the subfolders visited when recursing (0 is the input folder only). If not set there is no limit. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--walkThreads',
+                         type=int,
+                         action='store',
+                         help='number of threads listing the folders concurrently when recursing. This helps on network file systems. Default: %(default)s',
+                         default=DEFAULT_walkThreads,
+                         required=False)
+
     parser.add_argument('-s', '--sortMode',
                          type=int,
                          action='store',
                          default=DEFAULT_sortMode,
-                         help='defines the sorting order in which input the files will be processed: ' + str(SORT_NONE) + ' is no sorting, ' + str(SORT_LEXICOGRAPHICAL) + ' is lexicographical sorting, ' + str(SORT_HUMAN) + ' is human friendly sorting. Default: %(default)s')
+                         help='defines the sorting order in which input the files will be processed: ' + str(SORT_NONE) + ' is no sorting, ' + str(SORT_LEXICOGRAPHICAL) + ' is lexicographical sorting, ' + str(SORT_HUMAN) + ' is human friendly sorting (folder by folder), ' + str(SORT_MTIME) + ' is by modification time, ' + str(SORT_SIZE) + ' is by size. Default: %(default)s')
+
+    parser.add_argument('--sortMemory',
+                         type=int,
+                         action='store',
+                         help='maximum number of file names sorted in memory. Beyond that the sorted chunks are written to temporary files and merged, and the files are processed while they are merged. If not set, the files are sorted in memory. Default: %(default)s',
+                         default=DEFAULT_sortMemory,
+                         required=False)
 
     parser.add_argument('-f', '--fileFilter',
                          type=str,
@@ -478,7 +3606,33 @@ if __name__ == "__main__":
                          action='store',
                          help='the command to apply to the list of files. Note that ' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varInFile + '} denotes the input file, whereas ' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varOutFile + '} denotes the output file (see the notes at the end for more information). Default: %(default)s',
                          default=None,
-                         required=True)
+                         required=False)
+
+    parser.add_argument('--func',
+                         type=str,
+                         action='store',
+                         help='instead of a command, call this Python function, given as module:callable, for each file. The module must be importable (see PYTHONPATH). The function gets a dictionary with the variables exported to the commands, and returns the exit status (None stands for 0), an exception being a failure. The function is imported once per process, hence it can keep its state (loaded models, open handles, ...) between the files. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--funcPool',
+                         type=str,
+                         action='store',
+                         choices=(FUNC_POOL_PROCESS, FUNC_POOL_THREAD),
+                         help='where the function of --func runs: ' + FUNC_POOL_PROCESS + ' uses a pool of --jobs processes, which suits CPU bound functions, ' + FUNC_POOL_THREAD + ' calls it from the threads of the --parallel option, which suits I/O bound functions (their output is not captured). Default: %(default)s',
+                         default=DEFAULT_funcPool,
+                         required=False)
+
+    parser.add_argument('-b', '--batchSize',
+                         type=int,
+                         action='store',
+                         help='number of files passed to each invocation of the command. The command must then use the ' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varInFileList + '} and ' + DEFAULT_varMarker + '{' + DEFAULT_varPrefix + DEFAULT_varOutFileList + '} variables (see the notes at the end). Default: %(default)s',
+                         default=DEFAULT_batchSize,
+                         required=False)
+
+    parser.add_argument('--noShell',
+                         action='store_true',
+                         help='split the command in its arguments once and execute it directly, without the shell. This is faster and accepts any character in the file names, but shell features (pipes, redirections, ...) are not available. With the --batchSize option an argument made only of a list variable expands to one argument per file. The program is looked for in the PATH once, at startup')
 
     parser.add_argument('-r', '--recursive',
                          action='store_true',
@@ -488,13 +3642,200 @@ if __name__ == "__main__":
                          action='store_true',
                          help='process the files in parallel. In this case the suggested verbosity value is ' + str(VERBOSE_NONE))
 
+    parser.add_argument('-e', '--engine',
+                         type=str,
+                         action='store',
+                         choices=(ENGINE_THREAD, ENGINE_EVENT),
+                         help='how the commands are run in parallel: ' + ENGINE_THREAD + ' uses a pool of --jobs threads (and requires the --parallel option), ' + ENGINE_EVENT + ' keeps up to --jobs commands running from a single thread waiting for their outputs, which suits I/O bound commands run with a large --jobs value. Default: %(default)s',
+                         default=DEFAULT_engine,
+                         required=False)
+
+    parser.add_argument('-j', '--jobs',
+                         type=int,
+                         action='store',
+                         help='number of files processed at the same time when the --parallel option is set. Default: the number of CPUs (%(default)s)',
+                         default=DEFAULT_jobs,
+                         required=False)
+
+    parser.add_argument('--watch',
+                         action='store_true',
+                         help='keep running after processing the files, processing the files appearing in the input folder (created or moved in) as they come. The counters go on from the initial files. Default: %(default)s',
+                         default=False,
+                         required=False)
+
+    parser.add_argument('--watchSettle',
+                         type=float,
+                         action='store',
+                         help='seconds a new file must stay unchanged before being processed in --watch mode, so that the files being written are skipped. With --batchSize it is also the delay without new files after which a partial batch is processed. Default: %(default)s',
+                         default=DEFAULT_watchSettle,
+                         required=False)
+
+    parser.add_argument('--watchPolling',
+                         action='store_true',
+                         help='in --watch mode poll the folders instead of using inotify, e.g. on network file systems where inotify does not see the changes made by other hosts. Default: %(default)s',
+                         default=False,
+                         required=False)
+
+    parser.add_argument('--adaptive',
+                         action='store_true',
+                         help='adjust the number of files processed at the same time (starting at --jobs, which is also the maximum) to the load of the system, its memory and the throughput observed. Default: %(default)s',
+                         default=False,
+                         required=False)
+
+    parser.add_argument('--maxLoad',
+                         type=float,
+                         action='store',
+                         help='load average above which the --adaptive option reduces the number of files processed at the same time. Default: %(default)s',
+                         default=DEFAULT_maxLoad,
+                         required=False)
+
+    parser.add_argument('--maxMem',
+                         type=float,
+                         action='store',
+                         help='percentage of the physical memory in use above which the --adaptive option reduces the number of files processed at the same time. Default: %(default)s',
+                         default=DEFAULT_maxMem,
+                         required=False)
+
+    parser.add_argument('--largestFirst',
+                         action='store_true',
+                         help='process the largest files first, which shortens the end of a parallel run. The counters still follow the sorting mode. Not available with --stream, --sortMemory and --watch. Default: %(default)s',
+                         default=False,
+                         required=False)
+
+    parser.add_argument('--stream',
+                         action='store_true',
+                         help='start processing the files while the input folder is being scanned instead of listing all of them first. When sorting is enabled the files are sorted within each folder')
+
+    parser.add_argument('-i', '--incremental',
+                         action='store_true',
+                         help='skip the input files whose output is newer than the input, or that were already processed successfully with the same command according to the manifest')
+
+    parser.add_argument('--manifest',
+                         type=str,
+                         action='store',
+                         help='the SQLite database recording the processed files when the --incremental option is set. If not set, ' + DEFAULT_manifestFilename + ' in the output folder will be used. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--manifestHash',
+                         action='store_true',
+                         help='store the SHA1 of the input files in the manifest, so that files whose modification time changed but whose content did not are still skipped')
+
+    parser.add_argument('--shard',
+                         type=parseShard,
+                         action='store',
+                         help='process only the K-th of N shards of the files, given as K/N. A file belongs to a shard according to the hash of its path relative to the input path, so that N nodes sharing the tree split it without overlaps. The counters are the ones of the whole tree, provided the files are found in the same order on every node (i.e. sorted and without --walkThreads). Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--coordinator',
+                         type=str,
+                         action='store',
+                         help='do not process the files, hand them out to the workers connecting to this address instead (host:port for TCP, otherwise the path of a Unix socket). The workers ask for a few files at a time, so that the slow ones do not hold up the others. The log, the journal and the statistics are those of the whole run. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--connect',
+                         type=str,
+                         action='store',
+                         help='process the files handed out by the coordinator listening on this address, instead of looking for them. The name format and the filters are those of the coordinator. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--leaseSize',
+                         type=int,
+                         action='store',
+                         help='number of files the coordinator hands out to a worker at a time. Default: %(default)s',
+                         default=DEFAULT_leaseSize,
+                         required=False)
+
+    parser.add_argument('--journal',
+                         action='store_true',
+                         help='keep a journal of the files processed successfully, so that an interrupted run can be resumed with --resume. Default: %(default)s',
+                         default=False,
+                         required=False)
+
+    parser.add_argument('--journalFile',
+                         type=str,
+                         action='store',
+                         help='file of the journal. If not set, ' + DEFAULT_journalFilename + ' in the output path is used. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--resume',
+                         action='store_true',
+                         help='skip the files completed according to the journal of a previous run, which is continued. The counters are the ones of the original run. Implies --journal. Default: %(default)s',
+                         default=False,
+                         required=False)
+
+    parser.add_argument('--cacheDir',
+                         type=str,
+                         action='store',
+                         help='folder caching the output files by the content of the input files and the command. An input whose content was already processed with the same command gets its output from the cache (hard linked when possible) instead of running the command. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--cacheSize',
+                         type=int,
+                         action='store',
+                         help='maximum size of the cache in bytes. When exceeded the least recently used entries are removed. If not set the cache is not limited. Default: %(default)s',
+                         default=DEFAULT_cacheSize,
+                         required=False)
+
     parser.add_argument('-l', '--logFilename',
                          type=str,
                          action='store',
-                         help='creates a log CSV file that records the activity of %(prog)s. Default: %(default)s',
+                         help='creates a log file that records the activity of %(prog)s, one record per file. Default: %(default)s',
                          default=DEFAULT_logFilename,
                          required=False)
 
+    parser.add_argument('--logFormat',
+                         type=str,
+                         action='store',
+                         choices=(LOG_CSV, LOG_JSONL, LOG_SQLITE),
+                         help='format of the log: ' + LOG_CSV + ' rows, ' + LOG_JSONL + ' (one JSON object per line, with the sizes of the outputs of the command), or a ' + LOG_SQLITE + ' database. The logs can be searched with: %(prog)s query LOG. Default: %(default)s',
+                         default=DEFAULT_logFormat,
+                         required=False)
+
+    parser.add_argument('--outputLimit',
+                         type=int,
+                         action='store',
+                         help='maximum number of bytes of the output (and of the errors) of each command kept in memory and written in the log. Default: %(default)s',
+                         default=DEFAULT_outputLimit,
+                         required=False)
+
+    parser.add_argument('--spoolFolder',
+                         type=str,
+                         action='store',
+                         help='folder where the outputs longer than --outputLimit are written, one file per command. If not set, the folder named after the log file with the _output suffix is used, whereas without a log file the outputs are truncated. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--stats',
+                         action='store_true',
+                         help='print a summary with the time spent in each phase, the throughput, the per file latency percentiles, the worker utilization and the slowest files')
+
+    parser.add_argument('--statsFile',
+                         type=str,
+                         action='store',
+                         help='write the summary of the statistics in this JSON file. Default: %(default)s',
+                         default=None,
+                         required=False)
+
+    parser.add_argument('--statsTop',
+                         type=int,
+                         action='store',
+                         help='number of slowest files reported in the statistics. Default: %(default)s',
+                         default=DEFAULT_statsTop,
+                         required=False)
+
+    parser.add_argument('--profile',
+                         type=str,
+                         action='store',
+                         help='profile %(prog)s itself with cProfile, writing the profile in this file and printing the most expensive functions. Default: %(default)s',
+                         default=None,
+                         required=False)
+
     parser.add_argument('-v', '--verbosity',
                          type=int,
                          action='store',
@@ -505,7 +3846,22 @@ if __name__ == "__main__":
                          action='version',
                          version=' %(prog)s ' + str(VERSION))
 
-    args = parser.parse_args()
+    return parser
+
+
+def completeOptions(args):
+
+    if (args.command is None) == (args.func is None):
+        raise FileProcessorError('Either a command or a function (--func) must be given',
+                                 ERROR_INVALID_OPTIONS)
+
+    if args.func and (args.batchSize > 1 or args.engine == ENGINE_EVENT):
+        raise FileProcessorError('A function (--func) is called for each file, hence it cannot be used with --batchSize or the ' + ENGINE_EVENT + ' engine',
+                                 ERROR_INVALID_OPTIONS)
+
+    if args.largestFirst and (args.stream or args.sortMemory or args.watch):
+        raise FileProcessorError('--largestFirst needs the whole list of files, hence it cannot be used with --stream, --sortMemory or --watch',
+                                 ERROR_INVALID_OPTIONS)
 
     if args.outputPath == None:
         args.outputPath = args.inputPath
@@ -513,5 +3869,225 @@ if __name__ == "__main__":
         #    print Colors.FILE_PROCESSOR + \
         #        'Defaulting output path to' + Colors.ENDC, args.outputPath
 
-    # let'd go !
-    run(args)
+
+def convertOption(action, value):
+
+    # the strings given to the library are converted like on the command
+    # line, by the type of the option, and checked against its choices
+    if action is None:
+        return value
+
+    optionName = '/'.join(action.option_strings) or action.dest
+    if isinstance(value, basestring) and callable(action.type):
+        try:
+            value = action.type(value)
+        except argparse.ArgumentTypeError, e:
+            raise FileProcessorError('argument ' + optionName + ': ' + str(e),
+                                     ERROR_INVALID_OPTIONS)
+        except (TypeError, ValueError):
+            raise FileProcessorError('argument ' + optionName + ': invalid value ' + repr(value),
+                                     ERROR_INVALID_OPTIONS)
+
+    if action.choices is not None and value not in action.choices:
+        raise FileProcessorError('argument ' + optionName + ': invalid choice ' + repr(value) + ' (choose from ' + ', '.join(map(repr, action.choices)) + ')',
+                                 ERROR_INVALID_OPTIONS)
+    return value
+
+
+class FileProcessor(object):
+
+    # the library interface. The options are those of the command line, with
+    # the same names and defaults, e.g.
+    #
+    #     processor = FileProcessor('/data/in', 'convert ${FP_IN} ${FP_OUT}',
+    #                               outputPath='/data/out',
+    #                               nameFormat='${FP_BASENAME}.png',
+    #                               parallel=True)
+    #     for result in processor.results():
+    #         print result.input, result.status
+    #
+    # Unlike the command line nothing is printed, unless the verbosity is
+    # set. The errors raise a FileProcessorError
+    def __init__(self, inputPath, command=None, **options):
+        # argparse supplies the defaults (and converts them), the parser is
+        # built once per process
+        argv = ['--', inputPath]
+        if command is not None:
+            argv.insert(0, '--command=' + command)
+        parser = getParser()
+        self.options = parser.parse_args(argv)
+        options.setdefault('verbosity', VERBOSE_NONE)
+        actions = dict((action.dest, action) for action in parser._actions)
+        for name, value in options.iteritems():
+            if not hasattr(self.options, name):
+                raise TypeError('unknown option ' + name)
+            setattr(self.options, name,
+                    convertOption(actions.get(name), value))
+        completeOptions(self.options)
+
+        self._callbacks = []
+        self._cancelled = threading.Event()
+
+    def addCallback(self, callback):
+        # called with each Result as the files complete, from a thread of
+        # the processor
+        self._callbacks.append(callback)
+
+    def cancel(self):
+        # the files not started yet are skipped, the running commands
+        # complete
+        self._cancelled.set()
+
+    def results(self):
+        # the Result of each file, as the files complete. The files are
+        # processed by a thread, which is slowed down (rather than piling up
+        # the results) when they are not consumed
+        resultQueue = Queue.Queue(maxsize=DEFAULT_resultQueueSize)
+        failure = []
+        self._cancelled.clear()
+
+        def target():
+            try:
+                run(self.options, self._callbacks + [resultQueue.put],
+                    self._cancelled)
+            except Exception:
+                failure.append(sys.exc_info())
+            finally:
+                resultQueue.put(None)
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                # get() with a timeout, so that CTRL+C is not held up
+                try:
+                    result = resultQueue.get(True, 0.5)
+                except Queue.Empty:
+                    continue
+                if result is None:
+                    break
+                yield result
+        finally:
+            # when the consumer stops early, the run is cancelled and its
+            # remaining results drained, so that it can complete
+            if thread.isAlive():
+                self._cancelled.set()
+                while resultQueue.get() is not None:
+                    pass
+            while thread.isAlive():
+                thread.join(0.5)
+
+        if failure:
+            raise failure[0][0], failure[0][1], failure[0][2]
+
+    def run(self):
+        # process all the files, returns the number of files that failed
+        return sum(1 for result in self.results() if result.status != 0)
+
+
+commandLineParser = None
+
+
+def getParser():
+
+    global commandLineParser
+    if commandLineParser is None:
+        commandLineParser = createParser()
+    return commandLineParser
+
+
+def createQueryParser():
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]) + ' query',
+                                     description='Search the log written by the --logFilename option. Without options a summary is printed.')
+
+    parser.add_argument('logFilename',
+                        type=str,
+                        action='store',
+                        help='the log file (in any of the formats)')
+
+    parser.add_argument('--failures',
+                         action='store_true',
+                         help='list the files whose command failed')
+
+    parser.add_argument('--slowest',
+                         type=int,
+                         action='store',
+                         nargs='?',
+                         const=DEFAULT_querySlowest,
+                         help='list the N slowest files (%(const)s if N is omitted). Default: %(default)s',
+                         default=None)
+
+    return parser
+
+
+def query(argv):
+
+    # fileProcessor.py query LOG [--failures] [--slowest [N]]
+    args = createQueryParser().parse_args(argv)
+    if not os.path.isfile(args.logFilename):
+        raise FileProcessorError('The log ' + args.logFilename + ' does not exist',
+                                 ERROR_INPUT_PATH_DOES_NOT_EXIST)
+
+    if not args.failures and not args.slowest:
+        numberOfFiles, failed, wallTime = summarizeLog(args.logFilename)
+        print 'files: %d (%d failed), wall time %.3f s' % (numberOfFiles,
+                                                          failed, wallTime)
+        return
+
+    for inputFilename, outputFilename, status, wallTime in queryLog(
+            args.logFilename, args.failures, args.slowest):
+        print '%d\t%.4f\t%s\t%s' % (status, wallTime, inputFilename,
+                                    outputFilename or '')
+
+
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv and argv[0] == 'query':
+        try:
+            query(argv[1:])
+        except FileProcessorError, e:
+            print Colors.FAIL + str(e) + Colors.ENDC
+            sys.exit(e.code)
+        return
+
+    args = getParser().parse_args(argv)
+
+    # SIGTERM, the way a service is stopped, ends the run cleanly: no file
+    # is started anymore, the running commands complete and the logs, the
+    # manifest and the journal are closed
+    cancelled = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: cancelled.set())
+
+    try:
+        completeOptions(args)
+
+        # let'd go !
+        if args.profile:
+            import cProfile
+            import pstats
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run, args, cancelled=cancelled)
+            finally:
+                profiler.dump_stats(args.profile)
+                pstats.Stats(args.profile).sort_stats('cumulative').print_stats(
+                    DEFAULT_profileTop)
+        else:
+            run(args, cancelled=cancelled)
+    except FileProcessorError, e:
+        print Colors.FAIL + str(e) + Colors.ENDC
+        sys.exit(e.code)
+    except KeyboardInterrupt:
+        # run() closed what it opened on the way out
+        print Colors.FAIL + 'Interrupted' + Colors.ENDC
+        sys.exit(ERROR_INTERRUPTED)
+
+
+if __name__ == "__main__":
+    main()